@@ -101,37 +101,218 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import random
 import xml.etree.cElementTree as ET  # Use cElementTree or lxml if too slow
 
+# lxml is used for parsing when it is installed, otherwise the standard library
+try:
+    from lxml import etree as LET
+except ImportError:
+    LET = None
+
+PARSER_BACKENDS = ('lxml', 'cElementTree')
+PARSER_BACKEND = 'lxml' if LET is not None else 'cElementTree'
+
 OSM_FILE = "ex_w76EfPgoM8PsPLbMqJ93rbViRM5yT.osm"  # Replace this with your osm file
 SAMPLE_FILE = "sample.osm"
 
 k = 7 # Parameter: take every k-th top level element
 
-def get_element(osm_file, tags=('node', 'way', 'relation')):
+def get_backend(backend=None):
+    """Return the name of the parser backend to use, PARSER_BACKEND if backend is None"""
+    if backend is None:
+        return PARSER_BACKEND
+    if backend not in PARSER_BACKENDS:
+        raise ValueError("unknown parser backend %r, expected one of %s" % (backend, ', '.join(PARSER_BACKENDS)))
+    if backend == 'lxml' and LET is None:
+        raise ValueError("the lxml parser backend needs lxml installed")
+    return backend
+
+def iterparse(osm_file, events=('end',), tag=None, backend=None):
+    """iterparse osm_file with the chosen backend
+
+    lxml only reports the tags in tag and accepts huge text nodes and deep trees.
+    cElementTree ignores tag, so callers still have to check elem.tag.
+    """
+    if get_backend(backend) == 'lxml':
+        return LET.iterparse(osm_file, events=events, tag=tag, huge_tree=True)
+    return ET.iterparse(osm_file, events=events)
+
+def iter_elements(osm_file, tags=('node', 'way', 'relation'), backend=None):
+    """Yield each complete top level element in tags and free it once the caller moves on
+
+    Every top level element is freed, in tags or not, so reading only the
+    ways doesn't keep all the nodes before them in the tree.
+    """
+    if get_backend(backend) == 'lxml':
+        # lxml filters the tags itself, it reports all the nodes, ways and
+        # relations and the ones not in tags are only freed.  Clearing the
+        # element and dropping the elements before it keeps the tree from
+        # growing.
+        for _, elem in iterparse(osm_file, tag=set(tags) | set(('node', 'way', 'relation')), backend='lxml'):
+            if elem.tag in tags:
+                yield elem
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+    else:
+        context = iter(iterparse(osm_file, events=('start', 'end'), backend='cElementTree'))
+        _, root = next(context)
+        depth = 0
+        for event, elem in context:
+            if event == 'start':
+                depth += 1
+                continue
+            depth -= 1
+            if depth == 0:
+                if elem.tag in tags:
+                    yield elem
+                root.clear()
+
+def get_element(osm_file, tags=('node', 'way', 'relation'), backend=None):
     """Yield element if it is the right type of tag
 
     Reference:
     http://stackoverflow.com/questions/3095434/inserting-newlines-in-xml-file-generated-via-xml-etree-elementtree-in-python
     """
-    context = iter(ET.iterparse(osm_file, events=('start', 'end')))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end' and elem.tag in tags:
-            yield elem
-            root.clear()
+    return iter_elements(osm_file, tags, get_backend(backend))
+
+def element_tostring(element):
+    """Serialize element without its tail, the same whichever backend parsed it
+
+    cElementTree sorts attributes and lxml keeps them in document order, so
+    lxml elements are serialized through cElementTree.
+    """
+    if LET is not None and isinstance(element, LET._Element):
+        return ET.tostring(ET.fromstring(LET.tostring(element, with_tail=False)), encoding='utf-8')
+    tail = element.tail
+    element.tail = None
+    try:
+        return ET.tostring(element, encoding='utf-8')
+    finally:
+        element.tail = tail
+
+
+# Samplers pick top level elements on a first pass over the file.  offer()
+# sees every node, way and relation in file order and picked() returns the
+# (tag, id, node refs) of the ones kept, refs being empty for anything but
+# a way.  Only ids and refs are held, never the elements themselves.
+
+class EveryKth(object):
+    """Every k-th top level element"""
+
+    def __init__(self, k):
+        self.k = k
+        self.seen = 0
+        self.kept = []
+
+    def offer(self, element):
+        if self.seen % self.k == 0:
+            self.kept.append(element_key(element))
+        self.seen += 1
+
+    def picked(self):
+        return self.kept
+
+
+class Reservoir(object):
+    """A uniform random sample of size elements out of those in tags, however big the file"""
+
+    def __init__(self, size, tags=('node', 'way', 'relation'), seed=None):
+        self.size = size
+        self.tags = tags
+        self.random = random.Random(seed)
+        self.seen = 0
+        self.kept = []
+
+    def offer(self, element):
+        if element.tag not in self.tags:
+            return
+        self.seen += 1
+        if len(self.kept) < self.size:
+            self.kept.append(element_key(element))
+        else:
+            i = self.random.randint(0, self.seen - 1)
+            if i < self.size:
+                self.kept[i] = element_key(element)
+
+    def picked(self):
+        return self.kept
+
+
+class BoundingBox(object):
+    """The nodes inside the box, the ways with a node inside it and the relations with a member in the sample"""
+
+    def __init__(self, min_lat, min_lon, max_lat, max_lon):
+        self.box = (min_lat, min_lon, max_lat, max_lon)
+        self.ids = {'node': set(), 'way': set(), 'relation': set()}
+        self.kept = []
+
+    def offer(self, element):
+        min_lat, min_lon, max_lat, max_lon = self.box
+        key = element_key(element)
+        tag, element_id, refs = key
+        if tag == 'node':
+            inside = min_lat <= float(element.attrib['lat']) <= max_lat and min_lon <= float(element.attrib['lon']) <= max_lon
+        elif tag == 'way':
+            inside = any(ref in self.ids['node'] for ref in refs)
+        else:
+            inside = any(member.attrib['ref'] in self.ids.get(member.attrib['type'], ()) for member in element.iter('member'))
+        if inside:
+            self.ids.setdefault(tag, set()).add(element_id)
+            self.kept.append(key)
+
+    def picked(self):
+        return self.kept
+
+
+def element_key(element):
+    """(tag, id, node refs) of a top level element"""
+    if element.tag == 'way':
+        return element.tag, element.attrib['id'], tuple(nd.attrib['ref'] for nd in element.iter('nd'))
+    return element.tag, element.attrib['id'], ()
+
+def write_sample(osm_file, sample_file, sampler, complete=True, backend=None):
+    """Write the elements sampler picks from osm_file to sample_file, in file order
 
+    With complete=True every node a picked way refers to is written too, and
+    a relation is only written if all of its members are in the sample, so
+    the sample has no dangling references.  The file is read twice and only
+    the ids of the sample are kept in memory.
 
-with open(SAMPLE_FILE, 'wb') as output:
-    output.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-    output.write('<osm>\n  ')
+    Returns the number of elements written for each tag.
+    """
+    for element in get_element(osm_file, backend=backend):
+        sampler.offer(element)
+    
+    keep = set()
+    for tag, element_id, refs in sampler.picked():
+        keep.add((tag, element_id))
+        if complete:
+            keep.update(('node', ref) for ref in refs)
+    
+    counts = {'node': 0, 'way': 0, 'relation': 0}
+    with open(sample_file, 'wb') as output:
+        output.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        output.write('<osm>\n  ')
+        
+        for element in get_element(osm_file, backend=backend):
+            if (element.tag, element.attrib['id']) not in keep:
+                continue
+            if complete and element.tag == 'relation':
+                if not all((member.attrib['type'], member.attrib['ref']) in keep for member in element.iter('member')):
+                    continue
+            output.write(element_tostring(element) + '\n  ')
+            counts[element.tag] += 1
+        
+        output.write('</osm>')
+    return counts
 
-    # Write every kth top level element
-    for i, element in enumerate(get_element(OSM_FILE)):
-        if i % k == 0:
-            output.write(ET.tostring(element, encoding='utf-8'))
 
-    output.write('</osm>')
+# Write every kth top level element, plus the nodes of the ways among them.
+# Reservoir(10000, tags=('way',)) gives a fixed size sample instead, and
+# BoundingBox(42.10, -72.65, 42.12, -72.60) cuts out an area.
+write_sample(OSM_FILE, SAMPLE_FILE, EveryKth(k))
 
 
 # In[ ]:
@@ -161,13 +342,13 @@ def get_user(element):
         return id
 
 
-def process_map(filename):
+def process_map(filename, backend=None):
     users = set()
     
-    # This parses through all elements and that's why there are nulls.  It checks whether it has a uid only after getting to the function, so it's possible to have a nonetype there
-    for _, element in ET.iterparse(filename):
-        if get_user(element):
-            users.add(get_user(element))
+    # get_element only yields nodes, ways and relations, so every element has a uid
+    # and the tree is cleared as it goes
+    for element in get_element(filename, backend=backend):
+        users.add(get_user(element))
 
     return users
 
@@ -202,19 +383,28 @@ Note that your code will be tested with a different data file than the 'example.
 import xml.etree.cElementTree as ET
 import pprint
 
-def count_tags(filename):
+def count_tags(filename, backend=None):
     
     # Tag name is key, number of times encountered is value
     # 
     tag_dictionary = {}
     #tree = ET.parse(filename)
     #root = tree.getroot()
-    for _, element in ET.iterparse(filename):
+    
+    # Tags are counted as they start and the root is cleared after every top level
+    # element, the same way get_element does, so memory stays flat on big files
+    context = iter(iterparse(filename, events=('start', 'end'), backend=backend))
+    _, root = next(context)
+    tag_dictionary[root.tag] = 1
+    for event, element in context:
         #print element.tag
-        if element.tag in tag_dictionary:
-            tag_dictionary[element.tag] += 1
-        else:
-            tag_dictionary[element.tag] = 1
+        if event == 'start':
+            if element.tag in tag_dictionary:
+                tag_dictionary[element.tag] += 1
+            else:
+                tag_dictionary[element.tag] = 1
+        elif element.tag in ('node', 'way', 'relation'):
+            root.clear()
     return tag_dictionary
         # YOUR CODE HERE
 
@@ -309,12 +499,14 @@ def is_problem_char(attribute):
     m = problemchars.search(attribute)
     return m
 
-def process_map(filename):
+def process_map(filename, backend=None):
     keys = {"lower": 0, "lower_colon": 0, "problemchars": 0, "other": 0}
     
     # This iterates through the file, so you shouldn't have to go line by line in the key_type function
-    for _, element in ET.iterparse(filename):
-        keys = key_type(element, keys)
+    # Each node, way and relation is complete when get_element yields it
+    for element in get_element(filename, backend=backend):
+        for tag in element.iter('tag'):
+            keys = key_type(tag, keys)
         
     return keys
 
@@ -362,12 +554,13 @@ def audit_street_type(street_types, street_name):
             street_types[street_type].add(street_name)
     
 # This saves the street types to a set
-def audit(osmfile):
+def audit(osmfile, backend=None):
     street_names = set()
     osm_file = open(osmfile, "r")
     street_types = defaultdict(set)
     
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
+    # get_element yields each way once all of its tags have been parsed
+    for elem in get_element(osm_file, tags=('way',), backend=backend):
 
         if elem.tag == "way":
             is_hw = False
@@ -483,14 +676,15 @@ def is_highway(elem):
     else:
         return False
 
-def audit(osmfile):
+def audit(osmfile, backend=None):
     osm_file = open(osmfile, "r")
     street_types = defaultdict(set)
     address_types = defaultdict(set)
     area_codes = defaultdict(set)
     post_codes = defaultdict(set)
     
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
+    # get_element yields each node and way once all of its tags have been parsed
+    for elem in get_element(osm_file, tags=('node', 'way'), backend=backend):
 
         if elem.tag == "way":
             
@@ -680,6 +874,200 @@ def audit_address_type(address_types, address_name):
 audit_address_type(address_types, address)
 
 
+# In[ ]:
+
+# This block runs all of the audits above in a single pass over the file
+# Each audit is a collector: run_audits parses the file once and hands every
+# complete top level element (node, way, relation, ...) to each collector's
+# collect(), then calls finish() with the root.  The collectors give the same
+# results as count_tags, the uid process_map, key_type's process_map and the
+# two audit functions.
+import xml.etree.cElementTree as ET
+from collections import OrderedDict, defaultdict
+import pprint
+import re
+
+class TagCounter(object):
+    """Number of times each tag appears, like count_tags"""
+    name = 'tags'
+
+    def __init__(self):
+        self.tags = {}
+
+    def collect(self, element):
+        for elem in element.iter():
+            self.tags[elem.tag] = self.tags.get(elem.tag, 0) + 1
+
+    def finish(self, root):
+        self.tags[root.tag] = self.tags.get(root.tag, 0) + 1
+        return self.tags
+
+
+class UserCollector(object):
+    """Unique uids of the nodes, ways and relations, like the uid process_map"""
+    name = 'users'
+
+    def __init__(self):
+        self.users = set()
+
+    def collect(self, element):
+        if element.tag in ('node', 'way', 'relation'):
+            self.users.add(element.attrib['uid'])
+
+    def finish(self, root):
+        return self.users
+
+
+class KeyTypeCounter(object):
+    """Counts of lower, lower_colon, problemchars and other tag keys, like key_type"""
+    name = 'key_types'
+
+    def __init__(self):
+        self.keys = {"lower": 0, "lower_colon": 0, "problemchars": 0, "other": 0}
+        self.other_keys = set()
+
+    def collect(self, element):
+        for tag in element.iter('tag'):
+            attribute = tag.attrib['k']
+            if lower.search(attribute):
+                self.keys['lower'] += 1
+            elif lower_colon.search(attribute):
+                self.keys['lower_colon'] += 1
+            elif problemchars.search(attribute):
+                self.keys['problemchars'] += 1
+            else:
+                self.other_keys.add(attribute)
+                self.keys['other'] += 1
+
+    def finish(self, root):
+        return self.keys
+
+
+class HighwayNameAudit(object):
+    """Unexpected street types in the names of highway ways, like the street codes audit"""
+    name = 'highway_street_types'
+
+    def __init__(self):
+        self.street_types = defaultdict(set)
+
+    def collect(self, element):
+        if element.tag == 'way':
+            tags = element.findall('tag')
+            if any(tag.attrib['k'] == 'highway' and tag.attrib['v'] != 'bus_stop' for tag in tags):
+                for tag in tags:
+                    if tag.attrib['k'] == 'name':
+                        add_street_type(self.street_types, tag.attrib['v'])
+
+    def finish(self, root):
+        return dict(self.street_types)
+
+
+class AddressAudit(object):
+    """Street types, phone area codes, postcodes and bad zip codes, like audit(osmfile)"""
+    name = 'addresses'
+
+    def __init__(self):
+        self.street_types = defaultdict(set)
+        self.address_types = defaultdict(set)
+        self.area_codes = defaultdict(set)
+        self.post_codes = defaultdict(set)
+        self.highway_types = set()
+
+    def collect(self, element):
+        if element.tag == 'way':
+            for tag in element.iter('tag'):
+                k = tag.attrib['k']
+                v = tag.attrib['v']
+                if k == 'address':
+                    if not re.search(r'\d\d\d\d\d$', v):
+                        add_match(self.address_types, address_type_re, v.split(',')[0], v)
+                elif k == 'phone':
+                    add_match(self.area_codes, area_code_re, v, v)
+                elif k == 'highway' and v != 'bus_stop':
+                    self.highway_types.add(v)
+                elif k == 'addr:postcode':
+                    add_match(self.post_codes, post_code_re, v, v)
+        
+        elif element.tag == 'node':
+            tags = element.findall('tag')
+            for tag in tags:
+                k = tag.attrib['k']
+                v = tag.attrib['v']
+                
+                # A highway node's street name is on its name tag
+                if k == 'highway' and v != 'bus_stop':
+                    for name_tag in tags:
+                        if name_tag.attrib['k'] == 'name':
+                            add_street_type(self.street_types, name_tag.attrib['v'])
+                elif k == 'addr:street':
+                    add_street_type(self.street_types, v)
+                elif k == 'phone':
+                    add_match(self.area_codes, area_code_re, v, v)
+                elif k == 'address':
+                    if not re.search(r'\d\d\d\d\d$', v):
+                        add_match(self.address_types, address_type_re, v.split(',')[0], v)
+                elif k == 'addr:postcode':
+                    add_match(self.post_codes, post_code_re, v, v)
+
+    def finish(self, root):
+        return {'post_codes': dict(self.post_codes),
+                'street_types': dict(self.street_types),
+                'area_codes': dict(self.area_codes),
+                'bad_zip_codes': dict(self.address_types),
+                'highway_types': self.highway_types}
+
+
+def add_street_type(street_types, street_name):
+    m = street_type_re.search(street_name)
+    if m and m.group() not in expected:
+        street_types[m.group()].add(street_name)
+
+def add_match(groups, regex, text, value):
+    """Add value to groups under the part of text that regex matches"""
+    m = regex.search(text)
+    if m:
+        groups[m.group()].add(value)
+
+
+def run_audits(osm_file, collectors, backend=None):
+    """Feed every top level element of osm_file to each collector in a single parse
+
+    Returns an OrderedDict of each collector's name and result.
+    """
+    context = iter(iterparse(osm_file, events=('start', 'end'), backend=backend))
+    _, root = next(context)
+    depth = 0
+    for event, elem in context:
+        if event == 'start':
+            depth += 1
+        elif depth == 0:
+            # The end of the root
+            break
+        else:
+            depth -= 1
+            if depth == 0:
+                for collector in collectors:
+                    collector.collect(elem)
+                root.clear()
+    
+    return OrderedDict((collector.name, collector.finish(root)) for collector in collectors)
+
+def audit_report(osm_file, backend=None):
+    """Run every audit over osm_file in one pass"""
+    return run_audits(osm_file, [TagCounter(), UserCollector(), KeyTypeCounter(), HighwayNameAudit(), AddressAudit()], backend)
+
+
+def test():
+    report = audit_report('sample.osm')
+    for name, result in report.iteritems():
+        print name + ":"
+        pprint.pprint(result)
+
+
+if __name__ == "__main__":
+    test()
+
+
 # In[113]:
 
 ## This code will create dictionaries from all nodes and ways tags
@@ -699,16 +1087,33 @@ audit_address_type(address_types, address)
 # -*- coding: utf-8 -*-
 
 
+import array
+import bisect
 import csv
 import codecs
+import mmap
+import multiprocessing
+import operator
+import os
 import pprint
+import random
 import re
+import shutil
+import sqlite3
+import struct
+import tempfile
 import xml.etree.cElementTree as ET
-
-import cerberus
+from collections import Counter, OrderedDict
 
 import schema
 
+# pyarrow is only needed for output='parquet'
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
 OSM_PATH = "ex_w76EfPgoM8PsPLbMqJ93rbViRM5yT.osm"
 
 NODES_PATH = "nodes.csv"
@@ -717,6 +1122,10 @@ WAYS_PATH = "ways.csv"
 WAY_NODES_PATH = "ways_nodes.csv"
 WAY_TAGS_PATH = "ways_tags.csv"
 
+DB_PATH = "west-springfield.db"
+
+NODE_STORE_PATH = "nodes.store"
+
 LOWER_COLON = re.compile(r'^([a-z]|_)+:([a-z]|_)+')
 PROBLEMCHARS = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
 
@@ -729,10 +1138,238 @@ WAY_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
 WAY_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_NODES_FIELDS = ['id', 'node_id', 'position']
 
+# Output csvs in the order process_map writes them
+CSV_OUTPUTS = [(NODES_PATH, NODE_FIELDS),
+               (NODE_TAGS_PATH, NODE_TAGS_FIELDS),
+               (WAYS_PATH, WAY_FIELDS),
+               (WAY_NODES_PATH, WAY_NODES_FIELDS),
+               (WAY_TAGS_PATH, WAY_TAGS_FIELDS)]
+
+# Files for output='parquet', (path, schema section, fields), next to the
+# csvs.  Column types come from the schema and rows are written in row
+# groups of PARQUET_ROW_GROUP_ROWS.
+PARQUET_OUTPUTS = [(os.path.splitext(path)[0] + '.parquet', section, fields)
+                   for (path, fields), section in zip(CSV_OUTPUTS, ['node', 'node_tags', 'way', 'way_nodes', 'way_tags'])]
+PARQUET_TYPES = {'integer': 'int64', 'float': 'float64', 'string': 'string'}
+PARQUET_ROW_GROUP_ROWS = 100000
+PARQUET_COMPRESSION = 'snappy'
+
+# Tables for output='sqlite', the same schema the csv import cells create
+SQL_TABLES = OrderedDict([
+    ('nodes', (NODE_FIELDS, '''
+        CREATE TABLE nodes(id INTEGER primary key, 
+        lat REAL, 
+        lon REAL, 
+        user TEXT references ways, 
+        uid INTEGER references ways, 
+        version TEXT references ways, 
+        changeset INTEGER references ways, 
+        timestamp TEXT references ways)
+        ''')),
+    ('nodes_tags', (NODE_TAGS_FIELDS, '''
+        CREATE TABLE nodes_tags_coded(tag_id INTEGER primary key, 
+        id INTEGER references nodes, 
+        key_id INTEGER references tag_keys, 
+        value TEXT)
+        ''')),
+    ('ways', (WAY_FIELDS, '''
+        CREATE TABLE ways(id INTEGER primary key, 
+        user TEXT references nodes, 
+        uid INTEGER references nodes, 
+        version TEXT references nodes, 
+        changeset INTEGER references nodes, 
+        timestamp TEXT references nodes)
+        ''')),
+    ('ways_nodes', (WAY_NODES_FIELDS, '''
+        CREATE TABLE ways_nodes(id INTEGER references ways, 
+        node_id INTEGER references nodes (id), 
+        position INTEGER)
+        ''')),
+    ('ways_tags', (WAY_TAGS_FIELDS, '''
+        CREATE TABLE ways_tags_coded(tag_id INTEGER primary key, 
+        id INTEGER references ways, 
+        key_id INTEGER references tag_keys, 
+        value TEXT)
+        ''')),
+])
+
+# Tag keys and types are a few hundred (key, type) pairs repeated over every
+# tag row, so the tag tables store an integer id into the tag_keys lookup
+# table in place of the two strings.  nodes_tags and ways_tags are views over
+# the coded tables that join the strings back in, so queries against them
+# work as before.
+TAG_KEYS_TABLE = '''
+    CREATE TABLE tag_keys(id INTEGER primary key, 
+    key TEXT, 
+    type TEXT, 
+    unique (key, type))
+    '''
+TAG_TABLES = OrderedDict([('nodes_tags', 'nodes_tags_coded'), ('ways_tags', 'ways_tags_coded')])
+CODED_TAGS_FIELDS = ['id', 'key_id', 'value']
+TAG_VIEW = '''
+    CREATE VIEW {0} AS
+    SELECT {1}.id AS id, tag_keys.key AS key, {1}.value AS value, tag_keys.type AS type
+    FROM {1} JOIN tag_keys ON tag_keys.id = {1}.key_id
+    '''
+
+# Secondary indexes, (name, create statement), built after the rows are loaded.
+# These cover the lookups in the exploration queries: tags by key and value,
+# tags and way nodes by element id, way nodes by node and elements by user.
+SQL_INDEXES = [
+    ('nodes_tags_key_value', 'CREATE INDEX nodes_tags_key_value ON nodes_tags_coded(key_id, value)'),
+    ('ways_tags_key_value', 'CREATE INDEX ways_tags_key_value ON ways_tags_coded(key_id, value)'),
+    ('nodes_tags_id', 'CREATE INDEX nodes_tags_id ON nodes_tags_coded(id)'),
+    ('ways_tags_id', 'CREATE INDEX ways_tags_id ON ways_tags_coded(id)'),
+    ('ways_nodes_id_position', 'CREATE INDEX ways_nodes_id_position ON ways_nodes(id, position)'),
+    ('ways_nodes_node_id', 'CREATE INDEX ways_nodes_node_id ON ways_nodes(node_id)'),
+    ('nodes_user', 'CREATE INDEX nodes_user ON nodes(user)'),
+    ('ways_user', 'CREATE INDEX ways_user ON ways(user)'),
+]
+
+# R*Tree tables over the node points and the way bounding boxes, rebuilt
+# with the secondary indexes.  The bounds are in degrees; the R*Tree keeps
+# them as 32 bit floats rounded outwards, so a box search can return a few
+# extra rows right at its edges but never misses one.
+SPATIAL_TABLES = OrderedDict([
+    ('nodes_rtree', 'CREATE VIRTUAL TABLE nodes_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon)'),
+    ('ways_rtree', 'CREATE VIRTUAL TABLE ways_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon)'),
+])
+NODE_BOUNDS_SQL = 'INSERT INTO nodes_rtree SELECT id, lat, lat, lon, lon FROM nodes {0}'
+WAY_BOUNDS_SQL = '''
+    INSERT INTO ways_rtree
+    SELECT ways_nodes.id, min(lat), max(lat), min(lon), max(lon)
+    FROM ways_nodes JOIN nodes ON nodes.id = ways_nodes.node_id
+    {0} GROUP BY ways_nodes.id
+    '''
+
+# FTS5 index over the values of the tags people search by, built with the
+# secondary indexes.  Each row is one tag of a node or way; its rowid is the
+# tag_id of the tag in its coded table, times two plus 0 for nodes and 1 for
+# ways, so the rows of an element can be found again when it changes.
+# tag_id is the INTEGER PRIMARY KEY of the coded tables, which VACUUM keeps,
+# where a plain rowid could be renumbered.
+SEARCH_KEYS = ['name', 'address', 'addr:street', 'amenity']
+SEARCH_TABLE = '''
+    CREATE VIRTUAL TABLE tags_search USING fts5(value, k UNINDEXED, element UNINDEXED, id UNINDEXED,
+    tokenize = 'unicode61 remove_diacritics 1', prefix = '2 3')
+    '''
+SEARCH_SOURCES = OrderedDict([('node', ('nodes_tags_coded', 0)), ('way', ('ways_tags_coded', 1))])
+TAG_K_SQL = "CASE tag_keys.type WHEN 'regular' THEN tag_keys.key ELSE tag_keys.type || ':' || tag_keys.key END"
+SEARCH_SELECT_SQL = '''
+    SELECT {table}.tag_id * 2 + {kind}, {table}.value, {k}, '{element}', {table}.id
+    FROM {table} JOIN tag_keys ON tag_keys.id = {table}.key_id
+    WHERE {k} IN ({keys}) {where}
+    '''
+SEARCH_INSERT_SQL = 'INSERT INTO tags_search(rowid, value, k, element, id)' + SEARCH_SELECT_SQL
+SEARCH_DELETE_SQL = 'DELETE FROM tags_search WHERE rowid IN (SELECT tag_id * 2 + {kind} FROM {table} WHERE id = ?)'
+
+# Counts the reports read instead of grouping the tag tables every time,
+# table -> (create statement, select that counts them from scratch).  They
+# are counted with the secondary indexes, after the load, and from then on
+# triggers keep them up to date as rows are inserted and deleted.
+SUMMARY_VALUE_KEYS = ['postcode', 'amenity', 'name']
+SUMMARY_TABLES = OrderedDict([
+    ('tag_key_counts', ('''
+        CREATE TABLE tag_key_counts(element TEXT, key TEXT, total INTEGER, primary key (element, key))
+        ''', '''
+        SELECT 'node', tag_keys.key, count(*) FROM nodes_tags_coded
+        JOIN tag_keys ON tag_keys.id = nodes_tags_coded.key_id GROUP BY tag_keys.key
+        UNION ALL
+        SELECT 'way', tag_keys.key, count(*) FROM ways_tags_coded
+        JOIN tag_keys ON tag_keys.id = ways_tags_coded.key_id GROUP BY tag_keys.key
+        ''')),
+    ('tag_value_counts', ('''
+        CREATE TABLE tag_value_counts(element TEXT, key TEXT, value TEXT, total INTEGER,
+        primary key (element, key, value))
+        ''', '''
+        SELECT 'node', tag_keys.key, value, count(*) FROM nodes_tags_coded
+        JOIN tag_keys ON tag_keys.id = nodes_tags_coded.key_id
+        WHERE tag_keys.key IN ({keys}) GROUP BY tag_keys.key, value
+        UNION ALL
+        SELECT 'way', tag_keys.key, value, count(*) FROM ways_tags_coded
+        JOIN tag_keys ON tag_keys.id = ways_tags_coded.key_id
+        WHERE tag_keys.key IN ({keys}) GROUP BY tag_keys.key, value
+        '''.format(keys=', '.join("'{0}'".format(key) for key in SUMMARY_VALUE_KEYS)))),
+    ('user_counts', ('''
+        CREATE TABLE user_counts(user TEXT primary key, nodes INTEGER, ways INTEGER)
+        ''', '''
+        SELECT user, sum(element = 'node'), sum(element = 'way')
+        FROM (SELECT user, 'node' AS element FROM nodes UNION ALL SELECT user, 'way' FROM ways)
+        GROUP BY user
+        ''')),
+])
+
+# The triggers for each kind of element, on (element table, coded tag table)
+SUMMARY_SOURCES = OrderedDict([('node', ('nodes', 'nodes_tags_coded')), ('way', ('ways', 'ways_tags_coded'))])
+TAG_SUMMARY_TRIGGER = '''
+    CREATE TRIGGER {name} AFTER {event} ON {table} BEGIN
+        INSERT OR IGNORE INTO tag_key_counts(element, key, total)
+        SELECT '{element}', key, 0 FROM tag_keys WHERE id = {row}.key_id;
+        UPDATE tag_key_counts SET total = total {sign} 1
+        WHERE element = '{element}' AND key = (SELECT key FROM tag_keys WHERE id = {row}.key_id);
+        INSERT OR IGNORE INTO tag_value_counts(element, key, value, total)
+        SELECT '{element}', key, {row}.value, 0 FROM tag_keys WHERE id = {row}.key_id AND key IN ({keys});
+        UPDATE tag_value_counts SET total = total {sign} 1
+        WHERE element = '{element}' AND key = (SELECT key FROM tag_keys WHERE id = {row}.key_id) AND value IS {row}.value;
+        DELETE FROM tag_key_counts
+        WHERE element = '{element}' AND key = (SELECT key FROM tag_keys WHERE id = {row}.key_id) AND total = 0;
+        DELETE FROM tag_value_counts
+        WHERE element = '{element}' AND key = (SELECT key FROM tag_keys WHERE id = {row}.key_id) AND value IS {row}.value
+        AND total = 0;
+    END
+    '''
+USER_SUMMARY_TRIGGER = '''
+    CREATE TRIGGER {name} AFTER {event} ON {table} BEGIN
+        INSERT OR IGNORE INTO user_counts(user, nodes, ways) VALUES ({row}.user, 0, 0);
+        UPDATE user_counts SET {table} = {table} {sign} 1 WHERE user IS {row}.user;
+        DELETE FROM user_counts WHERE user IS {row}.user AND nodes = 0 AND ways = 0;
+    END
+    '''
+
+# Rows per executemany call and per transaction for output='sqlite'
+SQL_BATCH_ROWS = 10000
+SQL_TRANSACTION_ROWS = 1000000
+
+# Settings while bulk loading: no rollback journal or fsyncs, a 1GB page
+# cache and no foreign key checks.  The tables are rebuilt from scratch on
+# every load, so a crash part way through just means loading again.
+BULK_LOAD_PRAGMAS = OrderedDict([('journal_mode', 'OFF'),
+                                 ('synchronous', 'OFF'),
+                                 ('cache_size', -1024 * 1024),
+                                 ('temp_store', 'MEMORY'),
+                                 ('foreign_keys', 'OFF')])
+
+# Parallel conversion splits the file into this many shards per worker so
+# that a shard of heavily tagged ways doesn't hold up the whole pool
+SHARDS_PER_WORKER = 4
+SCAN_BYTES = 1024 * 1024
+# Number of distinct values each tag value cleaner remembers
+CLEAN_CACHE_SIZE = 10000
+
+ELEMENT_START = re.compile(r'<(?:node|way|relation)[\s/>]')
+OSM_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n<osm>\n'
+OSM_FOOTER = '</osm>\n'
+
+# The raw backend's patterns: the root, and a whole node, way or relation.
+# Attributes in double quotes and <tag k="" v=""/> and <nd ref=""/> children
+# are only read directly when the values have no line breaks or tabs, which
+# the XML parser would turn into spaces.
+RAW_ROOT = re.compile(r'<osm[\s>]')
+RAW_ELEMENT = re.compile(r'<(node|way|relation)(\s[^>/]*(?:/(?!>)[^>/]*)*)?(?:/>|>([^<]*(?:<(?!/\1>)[^<]*)*)</\1>)')
+RAW_ATTR = re.compile(r'([\w:.-]+)="([^"<\t\n\r]*)"')
+RAW_TAG = re.compile(r'<tag\s+k="([^"<\t\n\r]*)"\s+v="([^"<\t\n\r]*)"\s*/>')
+RAW_ND = re.compile(r'<nd\s+ref="([^"<\t\n\r]*)"\s*/>')
+RAW_ESCAPED = re.compile(r'[\x80-\xff&]')
+RAW_ENTITY = re.compile(r'&(?:#(\d+)|#x([0-9a-fA-F]+)|(\w+));')
+RAW_ENCODING = re.compile(r"""encoding=["']([\w.-]+)["']""")
+XML_ENTITIES = {'amp': u'&', 'lt': u'<', 'gt': u'>', 'quot': u'"', 'apos': u"'"}
+
 expected = ["Street", "Avenue", "Boulevard", "Drive", "Court", "Place", "Square", "Lane", "Road", 
             "Trail", "Parkway", "Commons", "Slope", "Circle", "Terrace", "Center"]
 
 # UPDATE THIS VARIABLE
+# Once the cells below have run, a change only takes effect through
+# set_mapping(), or rebuild_cleaner() after editing it in place
 mapping = { # These street types are abbreviations
             "St": "Street",
             "St ": "Street",
@@ -780,7 +1417,6 @@ def shape_element(element):
     node_attribs = {}
     way_attribs = {}
     way_nodes = []
-    tags = []  # Handle secondary tags the same way for both node and way elements
 
     # YOUR CODE HERE
     if element.tag == 'node':
@@ -798,76 +1434,10 @@ def shape_element(element):
         node_attribs['version'] = temp_node_attribs['version']
         node_attribs['changeset'] = temp_node_attribs['changeset']
         node_attribs['timestamp'] = temp_node_attribs['timestamp']
-                
-        ''' 
-        Sometimes, there are tags nested inside node tags.  Need a way 
-        to try to access these.  If it's a node tag, 
-        immediately check if there are tags nested within
-        
-        Check the solution from getting author email addys
-        '''
         
-        
-        # Need to capture any node tags
-        for tag in element.iter("tag"):
-            node_tag = {}
-            node_tag['id'] = node_attribs['id']
-            node_tag['value'] = tag.attrib['v']
-            key_plus_type = tag.attrib['k']
-            
-            # If there are problem characters, don't add to node tags
-            if is_problem_char(key_plus_type):
-                print key_plus_type
-                continue              
-            
-            # If there are colons, need to split up to get key
-            elif is_lower_colon(key_plus_type):
-                k_t_split = key_plus_type.split(':')
-                
-                # If ther are 2 colons, key is last two words joined by a colon
-                if len(k_t_split) == 3:
-                    node_tag['key'] = k_t_split[1] + ':' + k_t_split[2]
-                    node_tag['type'] = k_t_split[0]
-                    
-                    # Append the node tags to the list of node tags
-                    tags.append(node_tag)
-                
-                # If there is 1 colon
-                if len(k_t_split) == 2:
-                    node_tag['key'] = k_t_split[1]
-                    node_tag['type'] = k_t_split[0]
-                    
-                    # Checks if it's an 'addr:street' tag
-                    if is_street_name(tag):
-                        node_tag['value'] = update_name(node_tag['value'], mapping)
-                    
-                    # Checks if it's an 'addr:postcode' tag
-                    #elif is_post_code(tag):
-                        #print 'found a postcode: ' + tag.attrib['v']
-                        
-                    # Append the node tags to the list of node tags
-                    tags.append(node_tag)
-                
-            # If there are no colons, processing is easier
-            else:
-                node_tag['key'] = key_plus_type
-                
-                # Clean 'address' tags
-                if key_plus_type == 'address':
-                    node_tag['value'] = update_address(node_tag['value'], mapping)
-                    
-                # Clean 'name' tags
-                elif key_plus_type == 'name':                                
-                    if check_highway(element):
-                        node_tag['value'] = update_address(node_tag['value'], mapping)                   
-                
-                # Clean up 'phone' tags
-                elif key_plus_type == 'phone':
-                    node_tag['value'] = update_phone(node_tag['value'])
-                    
-                node_tag['type'] = 'regular'
-                # Append the node tags to the list of node tags
-                tags.append(node_tag)
+        # Node names on highways are cleaned like addresses
+        tag_pairs, highway = read_tags(element)
+        tags = shape_tags(node_attribs['id'], tag_pairs, highway, clean_address)
         
         return {'node': node_attribs, 'node_tags': tags}
     
@@ -884,86 +1454,127 @@ def shape_element(element):
         way_attribs['changeset'] = temp_way_attribs['changeset']
         way_attribs['timestamp'] = temp_way_attribs['timestamp']
         
-        ''' 
-        Sometimes, there are tags nested inside way tags.  Need a way 
-        to try to access these.  For instance, if it's a way tag, 
-        immediately check if there are nodes and tags nested within
-        '''
-        
         way_node_position = 0
-        for node in element.iter("nd"):
+        for ref in read_refs(element):
             way_node = {}
             way_node['id'] = way_attribs['id']
-            way_node['node_id'] = node.attrib['ref']
+            way_node['node_id'] = ref
             way_node['position'] = way_node_position
             way_node_position += 1
             way_nodes.append(way_node)
-          
-        # Need to capture any way tags
-        for tag in element.iter('tag'):
-            way_tag = {}
-            way_tag['id'] = way_attribs['id']
-            way_tag['value'] = tag.attrib['v']
-            key_plus_type = tag.attrib['k']
-            
-            # If there are problem characters, don't add to way tags
-            if is_problem_char(key_plus_type):
-                print key_plus_type
-                continue
-              
-            # If there are colons, need to split up to get key
-            elif is_lower_colon(key_plus_type):
-                
-                k_t_split = key_plus_type.split(':')
-                
-                # If ther are 2 colons, key is last two words joined by a colon
-                if len(k_t_split) == 3:
-                    way_tag['key'] = k_t_split[1] + ':' + k_t_split[2]
-                    way_tag['type'] = k_t_split[0]
-                    # Append the node tags to the list of node tags
-                    tags.append(way_tag)
-                # If there is 1 colon
-                if len(k_t_split) == 2:
-                    way_tag['key'] = k_t_split[1]
-                    way_tag['type'] = k_t_split[0]
-                    
-                    # Checks if it's an 'addr:street' tag
-                    if is_street_name(tag):
-                        #print "Old value: " + way_tag['value']
-                        way_tag['value'] = update_name(way_tag['value'], mapping)
-                        #print "New value: " + way_tag['value']
-                        
-                    # Append the node tags to the list of node tags
-                    tags.append(way_tag)
-                
-            # If there are no colons, processing is easier
-            else:
-                way_tag['key'] = key_plus_type
-                
-                # This cleans up name tags
-                if (key_plus_type == 'name'):# or (key_plus_type == 'address'):
-                    # Only name tags that are highways are actual street names
-                    if check_highway(element):
-                        way_tag['value'] = update_name(way_tag['value'], mapping)
-                
-                # This cleans up address tags
-                elif key_plus_type == 'address':
-                    way_tag['value'] = update_address(way_tag['value'], mapping)
-                    
-                # This cleans up phone tags
-                elif key_plus_type =='phone':
-                    way_tag['value'] = update_phone(way_tag['value'])
-                
-                way_tag['type'] = 'regular'
-                # Append the node tags to the list of way tags
-                tags.append(way_tag)
-            
-
+        
+        # Way names on highways are street names
+        tag_pairs, highway = read_tags(element)
+        tags = shape_tags(way_attribs['id'], tag_pairs, highway, clean_name)
         
         # way_attribs are the id, etc. way nodes include each id + relative position + way id, way tags are 
         return {'way': way_attribs, 'way_nodes': way_nodes, 'way_tags': tags}
 
 
+def read_tags(element):
+    """Read an element's tags once into (k, v) pairs and check if it is a highway"""
+    if isinstance(element, RawElement):
+        # The raw tokenizer has already read the pairs
+        for k, v in element.tag_pairs:
+            if k == 'highway' and v != 'bus_stop':
+                return element.tag_pairs, True
+        return element.tag_pairs, False
+    
+    tag_pairs = []
+    highway = False
+    for tag in element.iter('tag'):
+        attrib = tag.attrib
+        k = attrib['k']
+        v = attrib['v']
+        if k == 'highway' and v != 'bus_stop':
+            highway = True
+        tag_pairs.append((k, v))
+    return tag_pairs, highway
+
+
+def read_refs(element):
+    """The ids of the nodes in a way, in order"""
+    if isinstance(element, RawElement):
+        return element.refs
+    return [node.attrib['ref'] for node in element.iter('nd')]
+
+
+def shape_tags(element_id, tag_pairs, highway, clean_highway_name):
+    """Shape the (k, v) pairs from read_tags into node or way tag rows"""
+    tags = []
+    for key_plus_type, value in tag_pairs:
+        key_type = classify_key(key_plus_type)
+        
+        # If there are problem characters, don't add to tags
+        if key_type is PROBLEM_KEY:
+            print key_plus_type
+            continue
+        elif key_type is None:
+            continue
+        
+        # Clean street names, addresses, highway names and phone numbers
+        if key_plus_type == 'addr:street':
+            value = clean_name('addr:street', value)
+        elif key_plus_type == 'address':
+            value = clean_address('address', value)
+        elif key_plus_type == 'name':
+            # Only name tags that are highways are actual street names
+            if highway:
+                value = clean_highway_name('name', value)
+        elif key_plus_type == 'phone':
+            value = clean_phone('phone', value)
+        
+        tags.append({'id': element_id, 'key': key_type[0], 'value': value, 'type': key_type[1]})
+    return tags
+
+
+# Tag key -> (key, type).  Keys with problem characters map to PROBLEM_KEY
+# and keys with more than two colons, which aren't kept, map to None.
+KEY_CLASSES = {}
+KEY_CLASSES_SIZE = 100000
+PROBLEM_KEY = ('', 'problemchars')
+
+# One copy of each tag key and type string, so the shaped tag rows share
+# them instead of each holding its own
+TAG_STRINGS = {}
+
+def intern_tag(value):
+    return TAG_STRINGS.setdefault(value, value)
+
+
+def classify_key(key_plus_type):
+    """Split a tag key into its key and type, remembering the result for the next element"""
+    try:
+        return KEY_CLASSES[key_plus_type]
+    except KeyError:
+        pass
+    
+    if is_problem_char(key_plus_type):
+        key_type = PROBLEM_KEY
+    
+    # If there are colons, need to split up to get key
+    elif is_lower_colon(key_plus_type):
+        k_t_split = key_plus_type.split(':')
+        
+        # If ther are 2 colons, key is last two words joined by a colon
+        if len(k_t_split) == 3:
+            key_type = (k_t_split[1] + ':' + k_t_split[2], k_t_split[0])
+        elif len(k_t_split) == 2:
+            key_type = (k_t_split[1], k_t_split[0])
+        else:
+            key_type = None
+    
+    # If there are no colons, processing is easier
+    else:
+        key_type = (key_plus_type, 'regular')
+    
+    if len(KEY_CLASSES) < KEY_CLASSES_SIZE:
+        if key_type is not None and key_type is not PROBLEM_KEY:
+            key_type = (intern_tag(key_type[0]), intern_tag(key_type[1]))
+        KEY_CLASSES[key_plus_type] = key_type
+    return key_type
+
+
 # ================================================== #
 #               Helper Functions                     #
 # ================================================== #
@@ -975,42 +1586,54 @@ def check_highway(elem):
             return True
     return False
 
+class StreetCleaner(object):
+    """Rewrite the abbreviations in a mapping with a single pass over each value
+
+    The mapping is compiled once into a token table.  Values are split on
+    spaces and every token is looked up in the table, so the cost per value
+    doesn't grow with the size of the mapping and keys like 'St.' are
+    matched literally instead of as regular expressions.  A change to the
+    mapping afterwards needs a new cleaner, see rebuild_cleaner.
+    """
+
+    def __init__(self, mapping):
+        self.mapping = mapping
+        
+        # Tokens never contain a space, so only those keys can match one
+        self.tokens = dict((k, v) for k, v in mapping.iteritems() if ' ' not in k)
+
+    def clean_name(self, name):
+        get = self.tokens.get
+        return ' '.join([get(token, token) for token in name.split(' ')])
+
+    def clean_address(self, address):
+        
+        # Whole addresses with missing or incorrect zip codes are mapped directly
+        if address in self.mapping:
+            return self.mapping[address]
+        
+        # Only the street part, before the first comma, holds abbreviations
+        street, comma, rest = address.partition(',')
+        return self.clean_name(street) + comma + rest
+
+
+# Compiled cleaners by mapping, built once per mapping
+CLEANERS = {}
+
+def get_cleaner(mapping):
+    cleaner = CLEANERS.get(id(mapping))
+    if cleaner is None or cleaner.mapping is not mapping:
+        cleaner = CLEANERS[id(mapping)] = StreetCleaner(mapping)
+    return cleaner
+
+get_cleaner(mapping)
+
 def update_name(name, mapping):
-    
-    updated_name = name
-    
-    split_name = re.split(' ', name)
-    for nm in split_name:
-        if nm in mapping:
-            updated_name = re.sub(nm, mapping[nm], updated_name)
-    
-    return updated_name
+    return get_cleaner(mapping).clean_name(name)
 
 # This will look at the complete address, pull the street address and replace any street abbreviations with the appropriate mapping
 def update_address(address, mapping):
-    
-    updated_address = address
-    
-    # Check if the address has missing zip code info
-    if address in mapping:
-        # This updates all addresses with 00 for zip
-        updated_address = re.sub(address, mapping[address], updated_address)
-        return updated_address
-    
-    # Gets the street address
-    addy = address.split(',')[0]
-    
-    # Splits the street address up by spaces
-    split_addy = re.split(' ', addy)
-    
-    # Loops through the parts of the street address
-    for ad in split_addy:
-        
-        # If it finds an abbreviation, it replaces it
-        if ad in mapping:
-            updated_address = re.sub(ad, mapping[ad], updated_address)
-            
-    return updated_address
+    return get_cleaner(mapping).clean_address(address)
 
 def update_phone(phone):
     
@@ -1027,6 +1650,72 @@ def update_phone(phone):
     
     return updated_phone
 
+class CachedCleaner(object):
+    """Bounded LRU cache around a tag value cleaner, keyed by (tag key, raw value)
+
+    The same street names and phone numbers show up on thousands of
+    elements, so each distinct value only goes through the cleaner once
+    while it stays among the maxsize most recently used.
+    """
+
+    def __init__(self, cleaner, maxsize=CLEAN_CACHE_SIZE):
+        self.cleaner = cleaner
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, key, value):
+        cache_key = (key, value)
+        try:
+            cleaned = self.cache.pop(cache_key)
+            self.hits += 1
+        except KeyError:
+            cleaned = self.cleaner(value)
+            self.misses += 1
+            while len(self.cache) >= self.maxsize > 0:
+                self.cache.popitem(last=False)
+        if self.maxsize > 0:
+            self.cache[cache_key] = cleaned
+        return cleaned
+
+    def clear(self):
+        self.cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate(self):
+        """Drop the cached values but keep the counters"""
+        self.cache.clear()
+
+clean_name = CachedCleaner(lambda name: update_name(name, mapping))
+clean_address = CachedCleaner(lambda address: update_address(address, mapping))
+clean_phone = CachedCleaner(update_phone)
+
+CLEANER_CACHES = OrderedDict([('name', clean_name), ('address', clean_address), ('phone', clean_phone)])
+
+def rebuild_cleaner():
+    """Compile mapping again after it was edited and drop the names and addresses cleaned with the old one"""
+    CLEANERS[id(mapping)] = StreetCleaner(mapping)
+    CLEANER_CACHES['name'].invalidate()
+    CLEANER_CACHES['address'].invalidate()
+
+def set_mapping(new_mapping):
+    """Clean street names and addresses with new_mapping from now on"""
+    global mapping
+    mapping = new_mapping
+    rebuild_cleaner()
+
+def cache_stats():
+    """Return (hits, misses) for each cached cleaner"""
+    return dict((name, (cache.hits, cache.misses)) for name, cache in CLEANER_CACHES.iteritems())
+
+def print_cache_stats():
+    for name, cache in CLEANER_CACHES.iteritems():
+        total = cache.hits + cache.misses
+        hit_rate = 100.0 * cache.hits / total if total else 0.0
+        print "{0:<8} {1:>9} hits {2:>9} misses  {3:5.1f}% cached".format(name, cache.hits, cache.misses, hit_rate)
+
 # Checks whether a given element is a postal code
 def is_post_code(elem):
     #return ('post' in elem.attrib['k'])
@@ -1087,15 +1776,147 @@ def is_str(v):
     else:
         return False
     
-def get_element(osm_file, tags=('node', 'way', 'relation')):
-    """Yield element if it is the right type of tag"""
+def get_element(osm_file, tags=('node', 'way', 'relation'), backend=None):
+    """Yield element if it is the right type of tag
 
-    context = ET.iterparse(osm_file, events=('start', 'end'))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end' and elem.tag in tags:
-            yield elem
-            root.clear()
+    backend='raw' reads the elements straight from the bytes of osm_file,
+    which has to be a path, see iter_raw_elements.
+    """
+    if backend == 'raw':
+        return iter_raw_elements(osm_file, tags)
+    return iter_elements(osm_file, tags, get_backend(backend))
+
+
+# Python types each schema type has to be after coercion
+SCHEMA_TYPES = {'integer': (int, long), 'float': float, 'string': basestring}
+
+def compile_fields(field_schema):
+    """Turn the field rules of one schema entry into (name, required, coerce, types, type name) tuples"""
+    fields = []
+    for name, rules in field_schema.iteritems():
+        type_name = rules.get('type')
+        fields.append((name, rules.get('required', False), rules.get('coerce'),
+                       SCHEMA_TYPES.get(type_name, object), type_name))
+    return fields
+
+def compile_check(fields):
+    """Generate a function that returns True if a row passes every rule in fields
+
+    The rules are unrolled into a single expression so the hot loop doesn't
+    go field by field, e.g. for way_nodes:
+        isinstance(coerce0(row['id']), types0) and ... and len(row) == 3
+    """
+    env = {'known': frozenset(field[0] for field in fields)}
+    tests = []
+    for i, (name, required, coerce, types, type_name) in enumerate(fields):
+        env['coerce%d' % i] = coerce
+        env['types%d' % i] = types
+        value = 'row[%r]' % name
+        if coerce is not None:
+            value = 'coerce%d(%s)' % (i, value)
+        test = 'isinstance(%s, types%d)' % (value, i)
+        if not required:
+            test = '(%r not in row or %s)' % (name, test)
+        tests.append(test)
+    
+    # When every field is required, a row with the right length has no unknown fields
+    if all(field[1] for field in fields):
+        tests.append('len(row) == %d' % len(fields))
+    else:
+        tests.append('known.issuperset(row)')
+    
+    source = ('def check(row):\n'
+              '    try:\n'
+              '        return %s\n'
+              '    except (KeyError, TypeError, ValueError):\n'
+              '        return False\n') % ' and '.join(tests)
+    exec source in env
+    return env['check']
+
+def compile_schema(schema):
+    """Compile each top level schema entry into (is list, fields, check) for SchemaValidator"""
+    rules = {}
+    for section, section_schema in schema.iteritems():
+        is_list = section_schema['type'] == 'list'
+        if is_list:
+            fields = compile_fields(section_schema['schema']['schema'])
+        else:
+            fields = compile_fields(section_schema['schema'])
+        rules[section] = (is_list, fields, compile_check(fields))
+    return rules
+
+def check_fields(row, fields):
+    """Return a dict of cerberus style errors for one row, empty if it is valid"""
+    errors = {}
+    found = 0
+    for name, required, coerce, types, type_name in fields:
+        if name not in row:
+            if required:
+                errors[name] = ['required field']
+            continue
+        found += 1
+        value = row[name]
+        if value is None:
+            errors[name] = ['null value not allowed']
+            continue
+        if coerce is not None:
+            try:
+                value = coerce(value)
+            except (TypeError, ValueError) as e:
+                errors[name] = ["field '{0}' cannot be coerced: {1}".format(name, e),
+                                'must be of {0} type'.format(type_name)]
+                continue
+        if not isinstance(value, types):
+            errors[name] = ['must be of {0} type'.format(type_name)]
+    
+    # Fields that aren't in the schema
+    if found != len(row):
+        known = set(field[0] for field in fields)
+        for name in row:
+            if name not in known:
+                errors[name] = ['unknown field']
+    return errors
+
+
+class SchemaValidator(object):
+    """Validator compiled once from schema.schema
+
+    Checks the rules the schema uses (required, type and int/float coerce)
+    with generated python checks instead of going through cerberus for
+    every element, and only works out the detailed errors for rows that
+    fail.  Like cerberus.Validator it has validate() and errors, so it can
+    be passed to validate_element, and it leaves the document as is.
+    """
+
+    def __init__(self, schema=SCHEMA):
+        self.schema = schema
+        self.rules = compile_schema(schema)
+        self.errors = {}
+
+    def validate(self, document, schema=None):
+        if schema is not None and schema is not self.schema:
+            self.schema = schema
+            self.rules = compile_schema(schema)
+        
+        errors = {}
+        for section, value in document.iteritems():
+            if section not in self.rules:
+                errors[section] = ['unknown field']
+                continue
+            
+            is_list, fields, check = self.rules[section]
+            if is_list:
+                row_errors = {}
+                for i, row in enumerate(value):
+                    if not check(row):
+                        row_errors[i] = [check_fields(row, fields)]
+                if row_errors:
+                    errors[section] = [row_errors]
+            elif not check(value):
+                errors[section] = [check_fields(value, fields)]
+        
+        self.errors = errors
+        return not errors
 
 
 def validate_element(element, validator, schema=SCHEMA):
@@ -1108,6 +1929,109 @@ def validate_element(element, validator, schema=SCHEMA):
         raise Exception(message_string.format(field, error_string))
 
 
+# ================================================== #
+#               Sampled Validation                   #
+# ================================================== #
+
+# Policies for process_map(file_in, validate=policy).  A policy is called
+# with each shaped element and returns True if it should be validated.  In a
+# parallel run each shard gets a copy of the policy, from
+# policy.for_shard(shard) if it has state of its own to split.
+
+class EveryNth(object):
+    """Validate one in n elements, the ones whose id is a multiple of n
+
+    Choosing by id rather than counting the elements picks the same ones
+    however the file is split into shards.
+    """
+
+    def __init__(self, n):
+        self.n = n
+
+    def __call__(self, el):
+        section = el['node'] if 'node' in el else el['way']
+        return int(section['id']) % self.n == 0
+
+
+class RandomFraction(object):
+    """Validate a random fraction of the elements"""
+
+    def __init__(self, fraction, seed=None):
+        self.fraction = fraction
+        self.seed = seed
+        self.random = random.Random(seed)
+
+    def __call__(self, el):
+        return self.random.random() < self.fraction
+
+    def for_shard(self, shard):
+        """The policy for one shard, seeded from (seed, shard) so the shards draw different numbers"""
+        seed = None if self.seed is None else '{0}:{1}'.format(self.seed, shard)
+        return RandomFraction(self.fraction, seed)
+
+
+class CleanedOnly(object):
+    """Validate only the elements with a tag that went through one of the cleaners"""
+
+    def __call__(self, el):
+        tags = el.get('node_tags') or el.get('way_tags') or []
+        highway = False
+        cleaned_name = False
+        for tag in tags:
+            if tag['type'] == 'regular':
+                if tag['key'] in ('address', 'phone'):
+                    return True
+                elif tag['key'] == 'name':
+                    cleaned_name = True
+                elif tag['key'] == 'highway' and tag['value'] != 'bus_stop':
+                    highway = True
+            elif tag['type'] == 'addr' and tag['key'] == 'street':
+                return True
+        
+        # Names are only cleaned on highways
+        return cleaned_name and highway
+
+
+class ValidationReport(object):
+    """Counts of the sampled elements that were checked and the fields that failed"""
+
+    def __init__(self):
+        self.checked = 0
+        self.failed = 0
+        self.errors = Counter()
+
+    def check(self, el, validator):
+        self.checked += 1
+        if validator.validate(el) is not True:
+            self.failed += 1
+            for section, errors in validator.errors.iteritems():
+                for field in error_fields(errors):
+                    self.errors[section + '.' + field] += 1
+
+    def update(self, other):
+        self.checked += other.checked
+        self.failed += other.failed
+        self.errors.update(other.errors)
+
+    def show(self):
+        print "Validated {0} elements, {1} failed".format(self.checked, self.failed)
+        for field, count in self.errors.most_common():
+            print "  {0:<24} {1}".format(field, count)
+
+
+def error_fields(errors):
+    """Yield the field names in a cerberus style error list"""
+    for error in errors:
+        if isinstance(error, dict):
+            for field, nested in error.iteritems():
+                # Rows of list sections are keyed by their index
+                if isinstance(field, int):
+                    for name in error_fields(nested):
+                        yield name
+                else:
+                    yield field
+
+
 class UnicodeDictWriter(csv.DictWriter, object):
     """Extend csv.DictWriter to handle Unicode input"""
 
@@ -1122,47 +2046,1284 @@ class UnicodeDictWriter(csv.DictWriter, object):
 
 
 # ================================================== #
-#               Main Function                        #
+#               Output Writers                       #
 # ================================================== #
-def process_map(file_in, validate):
-    """Iteratively process each XML element and write to csv(s)"""
-
-    with codecs.open(NODES_PATH, 'w') as nodes_file,          codecs.open(NODE_TAGS_PATH, 'w') as nodes_tags_file,          codecs.open(WAYS_PATH, 'w') as ways_file,          codecs.open(WAY_NODES_PATH, 'w') as way_nodes_file,          codecs.open(WAY_TAGS_PATH, 'w') as way_tags_file:
 
-        nodes_writer = UnicodeDictWriter(nodes_file, NODE_FIELDS)
-        node_tags_writer = UnicodeDictWriter(nodes_tags_file, NODE_TAGS_FIELDS)
-        ways_writer = UnicodeDictWriter(ways_file, WAY_FIELDS)
-        way_nodes_writer = UnicodeDictWriter(way_nodes_file, WAY_NODES_FIELDS)
-        way_tags_writer = UnicodeDictWriter(way_tags_file, WAY_TAGS_FIELDS)
+# process_map writes shaped elements through one of these.  Each has
+# write(el) and close(), plus for_shard() and merge_shards() for the
+# parallel mode.
 
-        nodes_writer.writeheader()
-        node_tags_writer.writeheader()
-        ways_writer.writeheader()
-        way_nodes_writer.writeheader()
-        way_tags_writer.writeheader()
+class CsvOutput(object):
+    """Write shaped elements to the five csvs"""
 
-        validator = cerberus.Validator()
+    def __init__(self, paths=None, header=True):
+        paths = paths or [path for path, _ in CSV_OUTPUTS]
+        self.files = [codecs.open(path, 'w') for path in paths]
+        self.nodes_writer, self.node_tags_writer, self.ways_writer, self.way_nodes_writer, self.way_tags_writer = [
+            UnicodeDictWriter(f, fields) for f, (_, fields) in zip(self.files, CSV_OUTPUTS)]
         
+        if header:
+            self.nodes_writer.writeheader()
+            self.node_tags_writer.writeheader()
+            self.ways_writer.writeheader()
+            self.way_nodes_writer.writeheader()
+            self.way_tags_writer.writeheader()
+
+    def write(self, el):
+        if 'node' in el:
+            self.nodes_writer.writerow(el['node'])
+            self.node_tags_writer.writerows(el['node_tags'])
+        elif 'way' in el:
+            self.ways_writer.writerow(el['way'])
+            self.way_nodes_writer.writerows(el['way_nodes'])
+            self.way_tags_writer.writerows(el['way_tags'])
+
+    def close(self, error=False):
+        for f in self.files:
+            f.close()
+
+    @classmethod
+    def for_shard(cls, shard_dir):
+        return cls([os.path.join(shard_dir, os.path.basename(path)) for path, _ in CSV_OUTPUTS], header=False)
+
+    @staticmethod
+    def merge_shards(shard_dirs):
+        """Concatenate the per-shard csvs, in shard order, under a single header"""
+        for path, fields in CSV_OUTPUTS:
+            with codecs.open(path, 'w') as out_file:
+                UnicodeDictWriter(out_file, fields).writeheader()
+                for shard_dir in shard_dirs:
+                    with open(os.path.join(shard_dir, os.path.basename(path)), 'rb') as shard_file:
+                        shutil.copyfileobj(shard_file, out_file)
+
+
+def drop_table(conn, name):
+    """Drop a table or view if it exists, whichever name is"""
+    row = conn.execute("SELECT type FROM sqlite_master WHERE name = ? AND type IN ('table', 'view')", (name,)).fetchone()
+    if row is not None:
+        conn.execute('DROP {0} {1}'.format(row[0].upper(), name))
+
+def create_tables(conn):
+    """Drop and recreate the five tables, the tag_keys lookup table and the tag views"""
+    cur = conn.cursor()
+    for table in list(TAG_TABLES) + list(SPATIAL_TABLES) + ['tags_search'] + list(SUMMARY_TABLES):
+        drop_table(conn, table)
+    drop_table(conn, 'tag_keys')
+    cur.execute(TAG_KEYS_TABLE)
+    for table, (_, create) in SQL_TABLES.iteritems():
+        drop_table(conn, storage_table(table))
+        cur.execute(create)
+    for table, coded in TAG_TABLES.iteritems():
+        cur.execute(TAG_VIEW.format(table, coded))
+    conn.commit()
+
+def create_tag_table(conn, table):
+    """Drop and recreate the coded table and the view of one of the tag tables
+
+    tag_keys is created if it isn't there yet and kept if it is, so the
+    key ids the other tag table already uses stay the same.
+    """
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'tag_keys'").fetchone() is None:
+        conn.execute(TAG_KEYS_TABLE)
+    drop_table(conn, table)
+    drop_table(conn, storage_table(table))
+    conn.execute(SQL_TABLES[table][1])
+    conn.execute(TAG_VIEW.format(table, storage_table(table)))
+    conn.commit()
+
+def storage_table(table):
+    """The table the rows of table are stored in, the coded table for the tag views"""
+    return TAG_TABLES.get(table, table)
+
+def insert_sql(table):
+    fields = CODED_TAGS_FIELDS if table in TAG_TABLES else SQL_TABLES[table][0]
+    return 'INSERT INTO {0}({1}) VALUES ({2});'.format(storage_table(table), ', '.join(fields),
+                                                       ', '.join('?' * len(fields)))
+
+def row_values(table, tag_codes):
+    """Function from a shaped row of table to the values insert_sql(table) takes"""
+    values = operator.itemgetter(*SQL_TABLES[table][0])
+    if table in TAG_TABLES:
+        return lambda row: tag_codes.encode(values(row))
+    return values
+
+
+class TagCodes(object):
+    """The tag_keys ids of the (key, type) pairs in a database
+
+    The ids already in tag_keys are read once, new pairs are added to it as
+    they are first seen.
+    """
 
-        for element in get_element(file_in, tags=('node', 'way')):
-            el = shape_element(element)
-            if el:
-                if validate is True:
-                    validate_element(el, validator)
+    def __init__(self, conn):
+        self.conn = conn
+        self.ids = dict(((key, type_), id_) for id_, key, type_ in conn.execute('SELECT id, key, type FROM tag_keys'))
+
+    def code(self, key, type_):
+        try:
+            return self.ids[key, type_]
+        except KeyError:
+            cur = self.conn.execute('INSERT INTO tag_keys(key, type) VALUES (?, ?)', (key, type_))
+            self.ids[key, type_] = cur.lastrowid
+            return cur.lastrowid
+
+    def encode(self, row):
+        """An (id, key, value, type) tag row as the (id, key_id, value) row of its coded table"""
+        return row[0], self.code(row[1], row[3]), row[2]
+
+def create_indexes(conn):
+    """Build the secondary indexes and the spatial index once the tables are loaded"""
+    for name, create in SQL_INDEXES:
+        conn.execute('DROP INDEX IF EXISTS ' + name)
+        conn.execute(create)
+    create_spatial_index(conn)
+    create_search_index(conn)
+    create_summaries(conn)
+    
+    # Give the query planner statistics for the new indexes
+    conn.execute('ANALYZE')
+    conn.commit()
 
-                if element.tag == 'node':
-                    nodes_writer.writerow(el['node'])
-                    node_tags_writer.writerows(el['node_tags'])
-                elif element.tag == 'way':
-                    ways_writer.writerow(el['way'])
-                    way_nodes_writer.writerows(el['way_nodes'])
-                    way_tags_writer.writerows(el['way_tags'])
 
+def create_spatial_index(conn):
+    """Rebuild the R*Tree tables from the nodes and ways_nodes tables"""
+    for name, create in SPATIAL_TABLES.iteritems():
+        drop_table(conn, name)
+        conn.execute(create)
+    conn.execute(NODE_BOUNDS_SQL.format(''))
+    conn.execute(WAY_BOUNDS_SQL.format(''))
 
-if __name__ == '__main__':
-    # Note: Validation is ~ 10X slower. For the project consider using a small
-    # sample of the map when validating.
+def update_spatial_index(conn, tag, element_id):
+    """Bring the R*Tree rows of a node or way in line with its rows in the tables
+
+    A node also moves the bounds of the ways that go through it.
+    """
+    element_id = int(element_id)
+    if tag == 'node':
+        conn.execute('DELETE FROM nodes_rtree WHERE id = ?', (element_id,))
+        conn.execute(NODE_BOUNDS_SQL.format('WHERE id = ?'), (element_id,))
+        way_ids = [row[0] for row in conn.execute('SELECT DISTINCT id FROM ways_nodes WHERE node_id = ?', (element_id,))]
+    else:
+        way_ids = [element_id]
+    for way_id in way_ids:
+        conn.execute('DELETE FROM ways_rtree WHERE id = ?', (way_id,))
+        conn.execute(WAY_BOUNDS_SQL.format('WHERE ways_nodes.id = ?'), (way_id,))
+
+
+def search_select_sql(element, where=''):
+    """The rows of tags_search for the searchable tags of the nodes or ways"""
+    table, kind = SEARCH_SOURCES[element]
+    return SEARCH_SELECT_SQL.format(table=table, kind=kind, k=TAG_K_SQL, element=element, where=where,
+                                    keys=', '.join("'{0}'".format(key) for key in SEARCH_KEYS))
+
+def search_insert_sql(element, where=''):
+    table, kind = SEARCH_SOURCES[element]
+    return SEARCH_INSERT_SQL.format(table=table, kind=kind, k=TAG_K_SQL, element=element, where=where,
+                                    keys=', '.join("'{0}'".format(key) for key in SEARCH_KEYS))
+
+def create_search_index(conn):
+    """Rebuild the FTS5 table from the tags with a key in SEARCH_KEYS"""
+    drop_table(conn, 'tags_search')
+    conn.execute(SEARCH_TABLE)
+    for element in SEARCH_SOURCES:
+        conn.execute(search_insert_sql(element))
+    conn.execute("INSERT INTO tags_search(tags_search) VALUES ('optimize')")
+
+def remove_from_search_index(conn, element, element_id):
+    """Drop the search rows of a node or way, before its tag rows are deleted"""
+    table, kind = SEARCH_SOURCES[element]
+    conn.execute(SEARCH_DELETE_SQL.format(table=table, kind=kind), (int(element_id),))
+
+def add_to_search_index(conn, element, element_id):
+    """Index the searchable tags of a node or way once its tag rows are in"""
+    conn.execute(search_insert_sql(element, 'AND {0}.id = ?'.format(SEARCH_SOURCES[element][0])), (int(element_id),))
+
+
+def create_summaries(conn):
+    """Count the SUMMARY_TABLES from the loaded tables and add the triggers that keep them counted"""
+    for name, (create, select) in SUMMARY_TABLES.iteritems():
+        drop_table(conn, name)
+        conn.execute(create)
+        conn.execute('INSERT INTO {0} {1}'.format(name, select))
+    keys = ', '.join("'{0}'".format(key) for key in SUMMARY_VALUE_KEYS)
+    for element, (table, tags_table) in SUMMARY_SOURCES.iteritems():
+        for event, row, sign in (('INSERT', 'NEW', '+'), ('DELETE', 'OLD', '-')):
+            for trigger, source in ((USER_SUMMARY_TRIGGER, table), (TAG_SUMMARY_TRIGGER, tags_table)):
+                name = '{0}_{1}_summary'.format(source, event.lower())
+                conn.execute('DROP TRIGGER IF EXISTS ' + name)
+                conn.execute(trigger.format(name=name, table=source, event=event, row=row, sign=sign,
+                                            element=element, keys=keys))
+
+
+class BulkLoadProfile(object):
+    """Switch a connection to BULK_LOAD_PRAGMAS and back to its previous settings
+
+    Use it as a context manager around a load, or call apply() and
+    restore() when the load spans several calls.
+    """
+
+    def __init__(self, conn, pragmas=BULK_LOAD_PRAGMAS):
+        self.conn = conn
+        self.pragmas = pragmas
+        self.saved = None
+
+    def apply(self):
+        self.conn.commit()
+        self.saved = OrderedDict((name, self.conn.execute('PRAGMA ' + name).fetchone()[0]) for name in self.pragmas)
+        for name, value in self.pragmas.iteritems():
+            self.conn.execute('PRAGMA {0} = {1}'.format(name, value))
+
+    def restore(self):
+        self.conn.commit()
+        for name, value in self.saved.iteritems():
+            self.conn.execute('PRAGMA {0} = {1}'.format(name, value))
+
+    def __enter__(self):
+        self.apply()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.restore()
+
+
+# Copy the rows of a coded tag table from an attached shard, renumbering
+# their key_ids to the tag_keys ids of the main database
+SHARD_TAGS_SQL = '''
+    INSERT INTO main.{0}(id, key_id, value)
+    SELECT t.id, main_keys.id, t.value
+    FROM shard.{0} AS t
+    JOIN shard.tag_keys AS shard_keys ON shard_keys.id = t.key_id
+    JOIN main.tag_keys AS main_keys ON main_keys.key = shard_keys.key AND main_keys.type = shard_keys.type
+    ORDER BY t.tag_id
+    '''
+
+class SQLiteOutput(object):
+    """Write shaped elements straight into the database tables
+
+    Rows are buffered per table and inserted with executemany, and the
+    inserts are committed in large transactions rather than row by row.
+    """
+
+    def __init__(self, db_path=DB_PATH, batch_rows=SQL_BATCH_ROWS, transaction_rows=SQL_TRANSACTION_ROWS,
+                 indexes=True):
+        self.conn = sqlite3.connect(db_path)
+        self.profile = BulkLoadProfile(self.conn)
+        self.profile.apply()
+        create_tables(self.conn)
+        self.indexes = indexes
+        self.batch_rows = batch_rows
+        self.transaction_rows = transaction_rows
+        self.uncommitted = 0
+        self.batches = OrderedDict((table, []) for table in SQL_TABLES)
+        self.inserts = dict((table, insert_sql(table)) for table in SQL_TABLES)
+        self.tag_codes = TagCodes(self.conn)
+        self.row_values = dict((table, row_values(table, self.tag_codes)) for table in SQL_TABLES)
+
+    def add(self, table, rows):
+        batch = self.batches[table]
+        batch.extend(map(self.row_values[table], rows))
+        if len(batch) >= self.batch_rows:
+            self.flush(table)
+
+    def write(self, el):
+        if 'node' in el:
+            self.add('nodes', [el['node']])
+            self.add('nodes_tags', el['node_tags'])
+        elif 'way' in el:
+            self.add('ways', [el['way']])
+            self.add('ways_nodes', el['way_nodes'])
+            self.add('ways_tags', el['way_tags'])
+
+    def flush(self, table):
+        batch = self.batches[table]
+        if batch:
+            self.conn.executemany(self.inserts[table], batch)
+            self.uncommitted += len(batch)
+            del batch[:]
+        if self.uncommitted >= self.transaction_rows:
+            self.conn.commit()
+            self.uncommitted = 0
+
+    def close(self, error=False):
+        """Commit the last rows and build the indexes, unless the write failed
+
+        After an error the uncommitted rows are rolled back and no indexes are
+        built, so a half-loaded database doesn't look like a finished one.
+        """
+        if error:
+            self.conn.rollback()
+        else:
+            for table in self.batches:
+                self.flush(table)
+            self.conn.commit()
+            if self.indexes:
+                create_indexes(self.conn)
+        self.profile.restore()
+        self.conn.close()
+
+    @classmethod
+    def for_shard(cls, shard_dir):
+        return cls(os.path.join(shard_dir, 'shard.db'), indexes=False)
+
+    @staticmethod
+    def merge_shards(shard_dirs):
+        """Copy the rows of each shard database, in shard order, into the main one"""
+        conn = sqlite3.connect(DB_PATH)
+        with BulkLoadProfile(conn):
+            create_tables(conn)
+            for shard_dir in shard_dirs:
+                conn.execute('ATTACH DATABASE ? AS shard', (os.path.join(shard_dir, 'shard.db'),))
+                conn.execute('INSERT OR IGNORE INTO main.tag_keys(key, type) SELECT key, type FROM shard.tag_keys ORDER BY id')
+                for table in SQL_TABLES:
+                    if table in TAG_TABLES:
+                        # Each shard numbered its (key, type) pairs itself
+                        conn.execute(SHARD_TAGS_SQL.format(TAG_TABLES[table]))
+                    else:
+                        conn.execute('INSERT INTO main.{0} SELECT * FROM shard.{0}'.format(table))
+                conn.commit()
+                conn.execute('DETACH DATABASE shard')
+            create_indexes(conn)
+        conn.close()
+
+
+def parquet_schema(section, fields):
+    """The pyarrow schema of a table and the coerce function of each column, from the schema"""
+    rules = dict((rule[0], rule) for rule in compile_schema(SCHEMA)[section][1])
+    columns = []
+    coerces = []
+    for name in fields:
+        _, required, coerce, _, type_name = rules[name]
+        columns.append(pa.field(name, getattr(pa, PARQUET_TYPES[type_name])(), nullable=not required))
+        coerces.append(coerce)
+    return pa.schema(columns), coerces
+
+
+class ParquetTable(object):
+    """One table's parquet file, written in row groups of row_group_rows rows
+
+    Rows are turned into arrow tables as they come in and held until they
+    fill a whole row group, so the file only ever ends on one short group.
+    """
+
+    def __init__(self, path, section, fields, row_group_rows=PARQUET_ROW_GROUP_ROWS):
+        self.schema, self.coerces = parquet_schema(section, fields)
+        self.types = [field.type for field in (self.schema.field(name) for name in fields)]
+        self.row_values = operator.itemgetter(*fields)
+        self.row_group_rows = row_group_rows
+        self.rows = []
+        self.pending = []
+        self.pending_rows = 0
+        self.writer = pq.ParquetWriter(path, self.schema, compression=PARQUET_COMPRESSION)
+
+    def add(self, rows):
+        self.rows.extend(map(self.row_values, rows))
+        if len(self.rows) >= self.row_group_rows:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            arrays = [pa.array(column if coerce is None else map(coerce, column), type=column_type)
+                      for column, coerce, column_type in zip(zip(*self.rows), self.coerces, self.types)]
+            self.add_table(pa.Table.from_arrays(arrays, schema=self.schema))
+            del self.rows[:]
+
+    def add_table(self, table):
+        """Queue an arrow table, writing out every row group it fills"""
+        self.pending.append(table)
+        self.pending_rows += table.num_rows
+        if self.pending_rows >= self.row_group_rows:
+            self.write_groups()
+
+    def write_groups(self, last=False):
+        table = pa.concat_tables(self.pending)
+        full = table.num_rows if last else table.num_rows - table.num_rows % self.row_group_rows
+        if full:
+            self.writer.write_table(table.slice(0, full), row_group_size=self.row_group_rows)
+        rest = table.slice(full)
+        self.pending = [rest] if rest.num_rows else []
+        self.pending_rows = rest.num_rows
+
+    def close(self):
+        self.flush()
+        if self.pending:
+            self.write_groups(last=True)
+        self.writer.close()
+
+
+class ParquetOutput(object):
+    """Write shaped elements to a typed, compressed parquet file per table
+
+    The ids are int64, lat/lon float64 and the rest strings, as in the
+    schema, so the files load into DataFrames with pd.read_parquet without
+    parsing any text.  Needs pyarrow.
+    """
+
+    def __init__(self, paths=None, row_group_rows=PARQUET_ROW_GROUP_ROWS):
+        if pa is None:
+            raise ImportError("output='parquet' needs pyarrow")
+        paths = paths or [path for path, _, _ in PARQUET_OUTPUTS]
+        self.tables = OrderedDict((section, ParquetTable(path, section, fields, row_group_rows))
+                                  for path, (_, section, fields) in zip(paths, PARQUET_OUTPUTS))
+
+    def write(self, el):
+        for section, rows in el.iteritems():
+            self.tables[section].add(rows if isinstance(rows, list) else [rows])
+
+    def close(self, error=False):
+        for table in self.tables.itervalues():
+            table.close()
+
+    @classmethod
+    def for_shard(cls, shard_dir):
+        return cls([os.path.join(shard_dir, os.path.basename(path)) for path, _, _ in PARQUET_OUTPUTS])
+
+    @staticmethod
+    def merge_shards(shard_dirs):
+        """Append each shard's rows, in shard order, to the main files
+
+        The shards' short trailing row groups are regrouped on the way, so the
+        merged file has the same full row groups as a one-worker run.
+        """
+        for path, section, fields in PARQUET_OUTPUTS:
+            table = ParquetTable(path, section, fields)
+            for shard_dir in shard_dirs:
+                shard_file = pq.ParquetFile(os.path.join(shard_dir, os.path.basename(path)))
+                for i in range(shard_file.num_row_groups):
+                    table.add_table(shard_file.read_row_group(i))
+            table.close()
+
+
+OUTPUTS = {'csv': CsvOutput, 'sqlite': SQLiteOutput, 'parquet': ParquetOutput}
+
+
+# ================================================== #
+#               Parallel Conversion                  #
+# ================================================== #
+
+class ShardReader(object):
+    """File-like view of a byte range of the osm file wrapped in its own <osm> root"""
+
+    def __init__(self, osm_file, start, end):
+        self.file = open(osm_file, 'rb')
+        self.file.seek(start)
+        self.remaining = end - start
+        self.pending = [OSM_HEADER]
+
+    def read(self, size=-1):
+        if self.pending:
+            return self.pending.pop(0)
+        if self.remaining > 0:
+            if size < 0 or size > self.remaining:
+                size = self.remaining
+            data = self.file.read(size)
+            self.remaining -= len(data)
+            if data:
+                return data
+            self.remaining = 0
+        if self.file is not None:
+            self.close()
+            return OSM_FOOTER
+        return ''
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def find_element_start(osm_file, offset, limit):
+    """Return the offset of the first top level element at or after offset"""
+    osm_file.seek(offset)
+    position = offset
+    carry = ''
+    while position < limit:
+        chunk = osm_file.read(SCAN_BYTES)
+        if not chunk:
+            break
+        buf = carry + chunk
+        m = ELEMENT_START.search(buf)
+        if m:
+            return min(position - len(carry) + m.start(), limit)
+        carry = buf[-10:]
+        position += len(chunk)
+    return limit
+
+
+def find_shards(file_in, count):
+    """Split the osm file into byte ranges that start on <node>/<way>/<relation> boundaries"""
+    with open(file_in, 'rb') as osm_file:
+        osm_file.seek(0, os.SEEK_END)
+        size = osm_file.tell()
+
+        # Everything up to the closing </osm> tag belongs to the last shard
+        osm_file.seek(max(size - SCAN_BYTES, 0))
+        tail = osm_file.read()
+        data_end = size - len(tail) + tail.rfind('</osm>') if '</osm>' in tail else size
+
+        first = find_element_start(osm_file, 0, data_end)
+        step = max((data_end - first) // count, 1)
+        bounds = [first]
+        for i in range(1, count):
+            bounds.append(max(find_element_start(osm_file, first + i * step, data_end), bounds[-1]))
+        bounds.append(data_end)
+
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+
+
+def process_shard(job):
+    """Shape one byte range of the osm file into its own output in shard_dir"""
+    file_in, shard, start, end, validate, output, backend, node_store, shard_dir = job
+    if hasattr(validate, 'for_shard'):
+        validate = validate.for_shard(shard)
+
+    before = cache_stats()
+    shard_output = OUTPUTS[output].for_shard(shard_dir)
+    if node_store:
+        shard_output = NodeStoreOutput(shard_output, os.path.join(shard_dir, NODE_STORE_PATH))
+    if backend == 'raw':
+        report = write_elements(iter_raw_elements(file_in, ('node', 'way'), start, end), shard_output, validate)
+    else:
+        reader = ShardReader(file_in, start, end)
+        try:
+            report = write_elements(get_element(reader, tags=('node', 'way'), backend=backend), shard_output, validate)
+        finally:
+            reader.close()
+
+    # Workers handle several shards, so only report this shard's cache counters
+    after = cache_stats()
+    stats = dict((name, (after[name][0] - before[name][0], after[name][1] - before[name][1])) for name in after)
+    return stats, report
+
+
+def process_map_parallel(file_in, validate, workers, output, backend=None, node_store=None):
+    """Shape byte-range shards of the osm file in a process pool and merge the outputs"""
+    shards = find_shards(file_in, workers * SHARDS_PER_WORKER)
+    shard_root = tempfile.mkdtemp(prefix='osm-shards-', dir=os.path.dirname(os.path.abspath(NODES_PATH)))
+    jobs = []
+    for i, (start, end) in enumerate(shards):
+        shard_dir = os.path.join(shard_root, str(i))
+        os.mkdir(shard_dir)
+        jobs.append((file_in, i, start, end, validate, output, backend, node_store is not None, shard_dir))
+
+    try:
+        pool = multiprocessing.Pool(workers)
+        try:
+            # imap keeps the shard order so the merged rows match a single process run
+            results = list(pool.imap(process_shard, jobs))
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+        OUTPUTS[output].merge_shards([job[-1] for job in jobs])
+        if node_store is not None:
+            NodeStore.merge([os.path.join(job[-1], NODE_STORE_PATH) for job in jobs], node_store)
+    finally:
+        shutil.rmtree(shard_root)
+
+    # Fold the workers' cache counters into this process's cleaners
+    for stats, _ in results:
+        for name, (hits, misses) in stats.iteritems():
+            CLEANER_CACHES[name].hits += hits
+            CLEANER_CACHES[name].misses += misses
+
+    reports = [report for _, report in results if report is not None]
+    if not reports:
+        return None
+    report = ValidationReport()
+    for shard_report in reports:
+        report.update(shard_report)
+    return report
+
+
+# ================================================== #
+#               Raw Tokenizer                        #
+# ================================================== #
+
+class RawElement(object):
+    """A node or way read by the raw tokenizer
+
+    read_tags and read_refs use tag_pairs and refs directly.  get and iter
+    make it usable like an Element elsewhere; iter builds the <nd> and then
+    the <tag> children as it goes.
+    """
+    __slots__ = ('tag', 'attrib', 'tag_pairs', 'refs')
+
+    def __init__(self, tag, attrib, tag_pairs=(), refs=()):
+        self.tag = tag
+        self.attrib = attrib
+        self.tag_pairs = tag_pairs
+        self.refs = refs
+
+    def get(self, key, default=None):
+        return self.attrib.get(key, default)
+
+    def iter(self, tag=None):
+        if tag is None or self.tag == tag:
+            yield self
+        if tag is None or tag == 'nd':
+            for ref in self.refs:
+                yield RawElement('nd', {'ref': ref})
+        if tag is None or tag == 'tag':
+            for k, v in self.tag_pairs:
+                yield RawElement('tag', {'k': k, 'v': v})
+
+
+def raw_entity(match):
+    number, hex_number, name = match.groups()
+    if name is not None:
+        return XML_ENTITIES[name]
+    return unichr(int(number) if number is not None else int(hex_number, 16))
+
+def raw_value(value):
+    """Decode a utf-8 value the way expat does, a str if it is ascii and unicode otherwise
+
+    Raises KeyError or ValueError for a reference it can't expand.
+    """
+    text = value.decode('utf-8')
+    if u'&' in text:
+        if text.count(u'&') != len(RAW_ENTITY.findall(text)):
+            raise ValueError("bare '&' in %r" % value)
+        text = RAW_ENTITY.sub(raw_entity, text)
+    try:
+        return text.encode('ascii')
+    except UnicodeEncodeError:
+        return text
+
+def make_raw_element(tag, attributes, tag_pairs, refs, decode=False):
+    """Build a RawElement from its RAW_ATTR, RAW_TAG and RAW_ND matches
+
+    decode is True when the element has non-ascii bytes or references,
+    which leaves the values to be decoded.
+    """
+    if decode:
+        escaped = RAW_ESCAPED.search
+        attributes = [(k, raw_value(v) if escaped(v) else v) for k, v in attributes]
+        tag_pairs = [(raw_value(k) if escaped(k) else k, raw_value(v) if escaped(v) else v) for k, v in tag_pairs]
+        refs = [raw_value(ref) if escaped(ref) else ref for ref in refs]
+    return RawElement(tag, dict(attributes), tag_pairs, refs)
+
+def raw_gap_ok(buf, start, end):
+    """True if buf[start:end], between two elements, has no element, comment or CDATA that RAW_ELEMENT skipped"""
+    first = buf.find('<', start, end)
+    return first < 0 or (buf.find('<!', first, end) < 0 and ELEMENT_START.search(buf, first, end) is None)
+
+def iter_raw_elements(osm_file, tags=('node', 'way'), start=0, end=None):
+    """Yield the elements in tags from the bytes of the file at path osm_file
+
+    The file is mapped into memory and RAW_ELEMENT picks out each element.
+    Nodes and ways written the usual way (double quoted attributes with only
+    <tag>/<nd> children) become RawElements without building a tree.  Other
+    elements are parsed on their own by cElementTree.  A comment, CDATA or
+    an element start RAW_ELEMENT couldn't match between the elements, or an
+    element cElementTree can't parse on its own, sends the rest of the file
+    through get_element's XML parser.
+
+    start and end limit the scan to a byte range from find_shards.
+    """
+    with open(osm_file, 'rb') as fin:
+        buf = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if start == 0:
+            root = RAW_ROOT.search(buf)
+            prolog = buf[:root.start()] if root else ''
+            encoding = RAW_ENCODING.search(prolog)
+            if root is None or '<!DOCTYPE' in prolog or (encoding and encoding.group(1).lower() not in ('utf-8', 'utf8')):
+                for element in iter_elements(osm_file, tags):
+                    yield element
+                return
+            start = root.end()
+        if end is None:
+            end = buf.rfind('</osm>')
+            if end < 0:
+                end = len(buf)
+
+        position = start
+        for m in RAW_ELEMENT.finditer(buf, start, end):
+            element_start = m.start()
+            tag, attribute_text, body = m.groups('')
+            if not raw_gap_ok(buf, position, element_start):
+                break
+            if tag not in tags:
+                if '<!' in body:
+                    break
+                position = m.end()
+                continue
+            position = m.end()
+
+            element = None
+            if tag != 'relation':
+                attributes = RAW_ATTR.findall(attribute_text)
+                tag_pairs = RAW_TAG.findall(body)
+                refs = RAW_ND.findall(body) if tag == 'way' else []
+                
+                # Every attribute and every '<' in the body has to have been
+                # read.  Counting the '=' as well as the '"' catches the
+                # single quoted attributes RAW_ATTR doesn't match.
+                if (len(attributes) * 2 == attribute_text.count('"') and len(attributes) == attribute_text.count('=')
+                        and len(tag_pairs) + len(refs) == body.count('<')):
+                    decode = RAW_ESCAPED.search(buf, element_start, position) is not None
+                    try:
+                        element = make_raw_element(tag, attributes, tag_pairs, refs, decode)
+                    except (KeyError, ValueError):
+                        pass
+            
+            # Anything else in the element is left to cElementTree
+            if element is None:
+                try:
+                    element = ET.fromstring(buf[element_start:position])
+                except SyntaxError:
+                    position = element_start
+                    break
+            yield element
+        else:
+            if raw_gap_ok(buf, position, end):
+                return
+
+        reader = ShardReader(osm_file, position, end)
+        try:
+            for element in iter_elements(reader, tags):
+                yield element
+        finally:
+            reader.close()
+    finally:
+        buf.close()
+
+
+# ================================================== #
+#               Node Store                           #
+# ================================================== #
+
+def int64_typecode():
+    """The array typecode of a signed 64 bit integer on this platform"""
+    for typecode in ('l', 'q'):
+        try:
+            if array.array(typecode).itemsize == 8:
+                return typecode
+        except ValueError:
+            pass
+    raise ValueError("no 64 bit integer array type")
+
+# Node ids are int64 and lat/lon are fixed point int32 in units of 1e-7
+# degrees, the precision osm stores them with, so a node takes 16 bytes.
+# A saved store is the header (magic, node count) and then the three
+# arrays one after the other, in native byte order.
+NODE_ID_TYPECODE = int64_typecode()
+NODE_COORD_TYPECODE = 'i'
+NODE_COORD_SCALE = 10000000
+NODE_STORE_MAGIC = 'OSMNODES'
+NODE_STORE_HEADER = struct.Struct('=8sQ')
+
+class MappedArray(object):
+    """A read-only sequence of struct items at offset in a buffer
+
+    The arrays of a loaded NodeStore, read from the memory map as they
+    are indexed.
+    """
+    __slots__ = ('buf', 'offset', 'item', 'length')
+
+    def __init__(self, buf, offset, fmt, length):
+        self.buf = buf
+        self.offset = offset
+        self.item = struct.Struct(fmt)
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError('MappedArray index out of range')
+        return self.item.unpack_from(self.buf, self.offset + i * self.item.size)[0]
+
+    def tostring(self):
+        return self.buf[self.offset:self.offset + self.length * self.item.size]
+
+
+class NodeStore(object):
+    """Node ids and coordinates in parallel typed arrays, sorted by id
+
+    Nodes are added in file order and sorted by finish() if they weren't
+    in id order.  get() finds a node with a binary search over the ids.
+    save() writes the arrays to a file, load() memory maps a saved file so
+    the nodes are only read from disk as they are looked up.
+    """
+
+    def __init__(self, ids=None, lats=None, lons=None):
+        self.ids = array.array(NODE_ID_TYPECODE) if ids is None else ids
+        self.lats = array.array(NODE_COORD_TYPECODE) if lats is None else lats
+        self.lons = array.array(NODE_COORD_TYPECODE) if lons is None else lons
+        self.sorted = True
+        self.mapped = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, node_id):
+        return self.index(node_id) >= 0
+
+    def add(self, node_id, lat, lon):
+        node_id = int(node_id)
+        if self.ids and node_id <= self.ids[-1]:
+            self.sorted = False
+        self.ids.append(node_id)
+        self.lats.append(int(round(float(lat) * NODE_COORD_SCALE)))
+        self.lons.append(int(round(float(lon) * NODE_COORD_SCALE)))
+
+    def finish(self):
+        """Sort the nodes by id if they weren't added in order"""
+        if not self.sorted:
+            order = sorted(xrange(len(self.ids)), key=self.ids.__getitem__)
+            self.ids, self.lats, self.lons = [array.array(values.typecode, (values[i] for i in order))
+                                              for values in (self.ids, self.lats, self.lons)]
+            self.sorted = True
+
+    def index(self, node_id):
+        """The position of node_id in the arrays, or -1 if it isn't stored"""
+        node_id = int(node_id)
+        i = bisect.bisect_left(self.ids, node_id)
+        if i < len(self.ids) and self.ids[i] == node_id:
+            return i
+        return -1
+
+    def get(self, node_id, default=None):
+        """The (lat, lon) of a node as floats, or default if it isn't stored"""
+        i = self.index(node_id)
+        if i < 0:
+            return default
+        return self.lats[i] / float(NODE_COORD_SCALE), self.lons[i] / float(NODE_COORD_SCALE)
+
+    def save(self, path):
+        self.finish()
+        with open(path, 'wb') as fout:
+            fout.write(NODE_STORE_HEADER.pack(NODE_STORE_MAGIC, len(self.ids)))
+            for values in (self.ids, self.lats, self.lons):
+                fout.write(values.tostring())
+
+    @classmethod
+    def load(cls, path):
+        """Memory map a store written by save(), read-only"""
+        with open(path, 'rb') as fin:
+            buf = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count = NODE_STORE_HEADER.unpack_from(buf, 0)
+        if magic != NODE_STORE_MAGIC:
+            buf.close()
+            raise ValueError("{0} isn't a node store".format(path))
+        offset = NODE_STORE_HEADER.size
+        store = cls(MappedArray(buf, offset, '=q', count),
+                    MappedArray(buf, offset + 8 * count, '=i', count),
+                    MappedArray(buf, offset + 12 * count, '=i', count))
+        store.mapped = buf
+        return store
+
+    def close(self):
+        if self.mapped is not None:
+            self.mapped.close()
+            self.mapped = None
+
+    @classmethod
+    def merge(cls, paths, path):
+        """Join the stores saved by the shards, in shard order, into one saved at path"""
+        merged = cls()
+        for shard_path in paths:
+            shard = cls.load(shard_path)
+            try:
+                if len(shard) and len(merged) and shard.ids[0] <= merged.ids[-1]:
+                    merged.sorted = False
+                for values, shard_values in zip((merged.ids, merged.lats, merged.lons),
+                                                (shard.ids, shard.lats, shard.lons)):
+                    values.fromstring(shard_values.tostring())
+            finally:
+                shard.close()
+        merged.save(path)
+
+
+class NodeStoreOutput(object):
+    """Pass shaped elements on to output, keeping the nodes in a NodeStore saved at path on close"""
+
+    def __init__(self, output, path=NODE_STORE_PATH):
+        self.output = output
+        self.path = path
+        self.store = NodeStore()
+
+    def write(self, el):
+        if 'node' in el:
+            node = el['node']
+            self.store.add(node['id'], node['lat'], node['lon'])
+        self.output.write(el)
+
+    def close(self, error=False):
+        self.output.close(error)
+        if not error:
+            self.store.save(self.path)
+
+
+# ================================================== #
+#               Main Function                        #
+# ================================================== #
+def write_elements(elements, output, validate):
+    """Shape each XML element and write it through output
+
+    Returns a ValidationReport when validate is a sampling policy.
+    """
+    validator = SchemaValidator()
+    report = ValidationReport() if callable(validate) else None
+
+    try:
+        for element in elements:
+            el = shape_element(element)
+            if el:
+                if validate is True:
+                    validate_element(el, validator)
+                elif report is not None and validate(el):
+                    report.check(el, validator)
+
+                output.write(el)
+    except BaseException:
+        output.close(error=True)
+        raise
+    output.close()
+
+    return report
+
+
+def process_map(file_in, validate, workers=1, output='csv', backend=None, node_store=NODE_STORE_PATH):
+    """Iteratively process each XML element and write to csv(s)
+
+    validate is True to validate every element and stop at the first bad
+    one, or a sampling policy such as EveryNth(100), RandomFraction(0.01)
+    or CleanedOnly() to validate some of them and report the error counts
+    at the end.
+
+    output='sqlite' writes the elements straight into the tables of
+    DB_PATH instead of the csvs, skipping the csv import step, and
+    output='parquet' writes typed parquet files (needs pyarrow).
+
+    With workers > 1 the file is split into shards that are shaped in
+    parallel, the output is the same as a single process run.
+
+    backend picks the parser: 'lxml' or 'cElementTree', or 'raw' to read
+    nodes and ways straight from the bytes of the file.  The default is
+    PARSER_BACKEND.
+
+    The node ids and coordinates are also saved as a NodeStore at
+    node_store, pass None to skip it.
+    """
+    if workers > 1:
+        report = process_map_parallel(file_in, validate, workers, output, backend, node_store)
+    else:
+        main_output = OUTPUTS[output]()
+        if node_store is not None:
+            main_output = NodeStoreOutput(main_output, node_store)
+        report = write_elements(get_element(file_in, tags=('node', 'way'), backend=backend), main_output, validate)
+
+    if report is not None:
+        report.show()
+    return report
+
+
+if __name__ == '__main__':
+    # Note: SchemaValidator checks the schema with plain python, so validation
+    # adds a small fraction to the conversion time and can stay on.
     process_map(OSM_PATH, validate=True)
+    print_cache_stats()
+
+
+# In[ ]:
+
+# This block checks that a change to mapping reaches the street cleaners.
+# The names and addresses already cleaned with the old mapping have to go
+# with the old compiled cleaner, and a value costs the same to clean
+# however many entries the mapping has.
+import time
+
+def time_update_name(name, repeat=100000):
+    """Time, in microseconds, for one update_name call with mapping"""
+    start = time.time()
+    for _ in xrange(repeat):
+        update_name(name, mapping)
+    return (time.time() - start) / repeat * 1e6
+
+def test():
+    original = mapping
+    try:
+        # Edited in place
+        set_mapping(dict(original))
+        assert clean_name('name', 'Elm Blvd') == 'Elm Blvd'
+        mapping['Blvd'] = 'Boulevard'
+        rebuild_cleaner()
+        assert update_name('Elm Blvd', mapping) == 'Elm Boulevard'
+        assert clean_name('name', 'Elm Blvd') == 'Elm Boulevard'
+        assert clean_address('address', '12 Elm Blvd, Agawam MA') == '12 Elm Boulevard, Agawam MA'
+        
+        # Replaced
+        set_mapping(dict(original, Ln='Lane'))
+        assert clean_name('addr:street', 'Elm Ln') == 'Elm Lane'
+        assert clean_name('name', 'Elm Blvd') == 'Elm Blvd'
+        
+        # A much bigger mapping
+        small = time_update_name('Riverdale Rd')
+        large = dict(original)
+        large.update(('Abbr{0}'.format(i), 'Type{0}'.format(i)) for i in xrange(20000))
+        set_mapping(large)
+        assert clean_name('name', 'Riverdale Rd') == 'Riverdale Road'
+        large = time_update_name('Riverdale Rd')
+        print "update_name: {0:.2f} us with {1} entries, {2:.2f} us with {3}".format(
+            small, len(original), large, len(mapping))
+        assert large < small * 3
+    finally:
+        set_mapping(original)
+
+
+if __name__ == '__main__':
+    test()
+
+
+# In[ ]:
+
+# This block checks the sampling policies in a parallel run.  EveryNth has
+# to validate the same elements with one worker as with several, and the
+# shards of a seeded RandomFraction have to draw different numbers.
+import os
+import shutil
+import tempfile
+
+def policy_report(osm_file, policy, workers):
+    """The ValidationReport of converting osm_file in a temporary directory"""
+    cwd = os.getcwd()
+    work_dir = tempfile.mkdtemp(prefix='osm-policy-')
+    try:
+        os.chdir(work_dir)
+        return process_map(osm_file, policy, workers=workers, node_store=None)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir)
+
+def test(osm_file=OSM_PATH):
+    osm_file = os.path.abspath(osm_file)
+    serial = policy_report(osm_file, EveryNth(100), 1)
+    parallel = policy_report(osm_file, EveryNth(100), 3)
+    assert serial.checked > 0
+    assert (parallel.checked, parallel.failed, parallel.errors) == (serial.checked, serial.failed, serial.errors)
+    
+    policy = RandomFraction(0.5, seed=1)
+    draws = [tuple(policy.for_shard(shard).random.random() for _ in range(5)) for shard in range(3)]
+    assert len(set(draws)) == len(draws)
+    assert draws[0] == tuple(policy.for_shard(0).random.random() for _ in range(5))
+
+
+if __name__ == '__main__':
+    test()
+
+
+# In[ ]:
+
+# This block times how long shape_element spends on the tags of each element.
+# Way elements are rebuilt from the bundled ways.csv and ways_tags.csv, and the
+# old tag loop (both key regexes on every tag, plus a check_highway rescan of
+# all the tags for each name tag) is timed against read_tags + shape_tags.
+import csv
+import time
+import xml.etree.cElementTree as ET
+from collections import OrderedDict
+
+def load_bench_elements(ways_path=WAYS_PATH, tags_path=WAY_TAGS_PATH):
+    """Rebuild way elements with their tags from the csvs"""
+    elements = OrderedDict()
+    with open(ways_path, 'rb') as fin:
+        for row in csv.DictReader(fin):
+            elements[row['id']] = ET.Element('way', row)
+    
+    with open(tags_path, 'rb') as fin:
+        for row in csv.DictReader(fin):
+            if row['id'] in elements:
+                # The key and type columns were split from the original 'k'
+                if row['type'] == 'regular':
+                    k = row['key']
+                else:
+                    k = row['type'] + ':' + row['key']
+                ET.SubElement(elements[row['id']], 'tag', {'k': k, 'v': row['value'].decode('utf-8')})
+    return elements.values()
+
+def shape_tags_rescan(element):
+    """The way tag loop from before read_tags, kept to compare against"""
+    tags = []
+    for tag in element.iter('tag'):
+        way_tag = {}
+        way_tag['id'] = element.attrib['id']
+        way_tag['value'] = tag.attrib['v']
+        key_plus_type = tag.attrib['k']
+        
+        if is_problem_char(key_plus_type):
+            continue
+        elif is_lower_colon(key_plus_type):
+            k_t_split = key_plus_type.split(':')
+            if len(k_t_split) == 3:
+                way_tag['key'] = k_t_split[1] + ':' + k_t_split[2]
+                way_tag['type'] = k_t_split[0]
+                tags.append(way_tag)
+            if len(k_t_split) == 2:
+                way_tag['key'] = k_t_split[1]
+                way_tag['type'] = k_t_split[0]
+                if is_street_name(tag):
+                    way_tag['value'] = clean_name('addr:street', way_tag['value'])
+                tags.append(way_tag)
+        else:
+            way_tag['key'] = key_plus_type
+            if key_plus_type == 'name':
+                if check_highway(element):
+                    way_tag['value'] = clean_name('name', way_tag['value'])
+            elif key_plus_type == 'address':
+                way_tag['value'] = clean_address('address', way_tag['value'])
+            elif key_plus_type == 'phone':
+                way_tag['value'] = clean_phone('phone', way_tag['value'])
+            way_tag['type'] = 'regular'
+            tags.append(way_tag)
+    return tags
+
+def shape_tags_single_scan(element):
+    tag_pairs, highway = read_tags(element)
+    return shape_tags(element.attrib['id'], tag_pairs, highway, clean_name)
+
+def time_per_element(shape_tags_fn, elements, repeat=3):
+    """Best time, in microseconds, for shape_tags_fn on one element"""
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        for element in elements:
+            shape_tags_fn(element)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best / len(elements) * 1e6
+
+def benchmark():
+    elements = load_bench_elements()
+    
+    # Both versions have to shape the same rows for the timing to mean anything
+    for element in elements:
+        assert shape_tags_rescan(element) == shape_tags_single_scan(element)
+    
+    tag_count = sum(len(element) for element in elements)
+    print "Shaping tags of {0} ways ({1} tags)".format(len(elements), tag_count)
+    print "  rescan:      {0:6.2f} us per element".format(time_per_element(shape_tags_rescan, elements))
+    print "  single scan: {0:6.2f} us per element".format(time_per_element(shape_tags_single_scan, elements))
+
+
+if __name__ == '__main__':
+    benchmark()
+
+
+# In[ ]:
+
+# This block compares the parser backends on the same osm file.  Each backend
+# has to yield the same elements (serialized with element_tostring) before its
+# conversion time is counted.
+import hashlib
+import time
+
+def available_backends():
+    return [backend for backend in PARSER_BACKENDS if backend != 'lxml' or LET is not None]
+
+def element_digest(osm_file, backend):
+    """md5 of every node, way and relation in osm_file as the backend parses them"""
+    digest = hashlib.md5()
+    count = 0
+    for element in get_element(osm_file, backend=backend):
+        digest.update(element_tostring(element))
+        count += 1
+    return digest.hexdigest(), count
+
+def time_backend(osm_file, backend, repeat=3):
+    """Best time, in seconds, to parse and shape every node and way in osm_file"""
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        for element in get_element(osm_file, tags=('node', 'way'), backend=backend):
+            shape_element(element)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def benchmark_backends(osm_file=OSM_PATH):
+    backends = available_backends()
+    digests = dict((backend, element_digest(osm_file, backend)) for backend in backends)
+    assert len(set(digests.values())) == 1, digests
+    
+    print "Parsing and shaping {0} ({1} elements)".format(osm_file, digests[backends[0]][1])
+    for backend in backends:
+        print "  {0:<13} {1:6.2f} s".format(backend + ':', time_backend(osm_file, backend))
+    if LET is None:
+        print "  (lxml is not installed)"
+
+
+if __name__ == '__main__':
+    benchmark_backends()
+
+
+# In[ ]:
+
+# This block checks the raw tokenizer against the XML parser.  The file is
+# shaped through both into csvs in a temporary directory, every row has to
+# match, and then both are timed.
+import csv
+import os
+import shutil
+import tempfile
+
+def convert_with(osm_file, out_dir, backend):
+    """Shape the nodes and ways of osm_file into the five csvs in out_dir"""
+    output = CsvOutput([os.path.join(out_dir, os.path.basename(path)) for path, _ in CSV_OUTPUTS])
+    write_elements(get_element(osm_file, tags=('node', 'way'), backend=backend), output, False)
+
+# Elements the tokenizer can only read in part, single quoted attributes
+# among them, have to come out the same as the XML parser reads them
+QUOTING_SAMPLE = """<?xml version='1.0' encoding='UTF-8'?>
+<osm version="0.6">
+ <node id='1' lat='42.1' lon='-72.6' user='a' uid='1' version='1' changeset='1' timestamp='2016-01-01T00:00:00Z'/>
+ <node id="2" lat='42.2' lon="-72.6" user="O'Brien" uid="2" version="1" changeset="1" timestamp="2016-01-01T00:00:00Z"><tag k="name" v="x"/></node>
+ <way id="3" user='b' uid="1" version="1" changeset="1" timestamp="2016-01-01T00:00:00Z"><nd ref="1"/><nd ref='2'/><tag k='highway' v="residential"/></way>
+</osm>
+"""
+
+def read_rows(path):
+    with open(path, 'rb') as f:
+        return list(csv.reader(f))
+
+def shaped(osm_file, backend):
+    return [shape_element(element) for element in get_element(osm_file, tags=('node', 'way'), backend=backend)]
+
+def test(osm_file=OSM_PATH):
+    out_root = tempfile.mkdtemp(prefix='osm-raw-')
+    try:
+        quoting_file = os.path.join(out_root, 'quoting.osm')
+        with open(quoting_file, 'wb') as f:
+            f.write(QUOTING_SAMPLE)
+        assert shaped(quoting_file, 'raw') == shaped(quoting_file, PARSER_BACKEND)
+        
+        for backend in (PARSER_BACKEND, 'raw'):
+            os.mkdir(os.path.join(out_root, backend))
+            convert_with(osm_file, os.path.join(out_root, backend), backend)
+        
+        for path, _ in CSV_OUTPUTS:
+            name = os.path.basename(path)
+            expected = read_rows(os.path.join(out_root, PARSER_BACKEND, name))
+            assert read_rows(os.path.join(out_root, 'raw', name)) == expected, name
+            print "{0}: {1} rows match".format(name, len(expected) - 1)
+    finally:
+        shutil.rmtree(out_root)
+    
+    for backend in (PARSER_BACKEND, 'raw'):
+        print "  {0:<13} {1:6.2f} s".format(backend + ':', time_backend(osm_file, backend))
+
+
+if __name__ == '__main__':
+    test()
 
 
 # In[ ]:
@@ -1174,6 +3335,80 @@ updated_phone = updated_phone = re.sub(r'..\s+(\d\d\d)\s+(\d\d\d)(\d\d\d\d)', r'
 print updated_phone
 
 
+# In[ ]:
+
+# Import all five csvs into the database in one go
+# The load runs under BulkLoadProfile (no journal, no fsyncs, big page cache),
+# the secondary indexes are built once the rows are in, and the usual
+# settings are put back at the end.  Rows are streamed from the csvs in
+# fixed-size chunks, so memory use doesn't depend on the size of the files.
+import csv
+import itertools
+import resource
+import sqlite3
+import sys
+import time
+
+# Rows per executemany call when loading the csvs
+LOAD_CHUNK_ROWS = 50000
+
+def chunked(rows, size=LOAD_CHUNK_ROWS):
+    """Yield lists of up to size rows from an iterable without reading ahead"""
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    
+    # ru_maxrss is in bytes on macOS and kilobytes on Linux
+    if sys.platform == 'darwin':
+        return peak / (1024.0 * 1024.0)
+    return peak / 1024.0
+
+def bulk_import(db_path=DB_PATH):
+    """Load the five csvs into db_path and return rows/sec for each table"""
+    conn = sqlite3.connect(db_path)
+    rates = OrderedDict()
+    with BulkLoadProfile(conn):
+        create_tables(conn)
+        tag_codes = TagCodes(conn)
+        for table, (path, fields) in zip(SQL_TABLES, CSV_OUTPUTS):
+            start = time.time()
+            with open(path, 'rb') as fin:
+                reader = csv.reader(fin)
+                header = next(reader)
+                assert header == fields, "{0} columns don't match the {1} table".format(path, table)
+                
+                # The csvs are utf-8, sqlite wants unicode text
+                rows = (tuple(value.decode('utf-8') for value in row) for row in reader)
+                if table in TAG_TABLES:
+                    rows = itertools.imap(tag_codes.encode, rows)
+                count = 0
+                for chunk in chunked(rows):
+                    conn.executemany(insert_sql(table), chunk)
+                    count += len(chunk)
+            conn.commit()
+            elapsed = time.time() - start
+            rates[table] = count / elapsed if elapsed else float(count)
+            print "{0:<12} {1:>10} rows {2:8.2f}s {3:>10.0f} rows/sec {4:8.1f} MB peak RSS".format(
+                table, count, elapsed, rates[table], peak_rss_mb())
+        
+        start = time.time()
+        create_indexes(conn)
+        print "{0:<12} {1:>10} built {2:8.2f}s".format('indexes', len(SQL_INDEXES), time.time() - start)
+    conn.close()
+    return rates
+
+
+if __name__ == '__main__':
+    bulk_import()
+
+
 # In[116]:
 
 # Create Nodes Database
@@ -1211,24 +3446,23 @@ cur.execute('''
 # commit the changes
 conn.commit()
 
-# Read in the csv file as a dictionary, format the data as a list of tuples:
+# Read in the csv file as a dictionary, format the data as a stream of tuples:
 with open('nodes.csv', 'rb') as fin:
     dr = csv.DictReader(fin) # comma is default limiter
-    to_db = [(i['id'], i['lat'], i['lon'], i['user'].decode("utf-8"), i['uid'], i['version'].decode("utf-8"), i['changeset'], i['timestamp'].decode("utf-8")) for i in dr]
+    to_db = ((i['id'], i['lat'], i['lon'], i['user'].decode("utf-8"), i['uid'], i['version'].decode("utf-8"), i['changeset'], i['timestamp'].decode("utf-8")) for i in dr)
 
-# insert the formatted data
-cur.executemany("INSERT INTO nodes(id, lat, lon, user, uid, version, changeset, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?, ?);", to_db)
-# commit the changes
-conn.commit()
+    # insert the formatted data a chunk at a time and commit the changes
+    for chunk in chunked(to_db):
+        cur.executemany("INSERT INTO nodes(id, lat, lon, user, uid, version, changeset, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?, ?);", chunk)
+        conn.commit()
+print "Peak RSS: {0:.1f} MB".format(peak_rss_mb())
 
 cur.execute('SELECT * FROM nodes')
-all_rows = cur.fetchall()
+# Only fetch the rows that get printed
+all_rows = cur.fetchmany(100)
 print('1):')
-for i, row in enumerate(all_rows):
-    if i < 100:
-        print row
-    else:
-        break
+for row in all_rows:
+    print row
 #pprint(all_rows)
 
 conn.close()
@@ -1252,40 +3486,31 @@ NODE_TAGS_PATH = "nodes_tags.csv"
 # Get a cursor object
 cur = conn.cursor()
 
-# Before creating the table, drop the table if it already exists
-cur.execute('DROP TABLE IF EXISTS nodes_tags')
-conn.commit()
-
-# Create the table, specifying the column names and data types:
-cur.execute('''
-    CREATE TABLE nodes_tags(id INTEGER references nodes, 
-    key TEXT, 
-    value TEXT, 
-    type TEXT)
-    ''')
+# Drop and recreate the table the tags are stored in, nodes_tags_coded, and
+# the nodes_tags view over it.  The key and type of each tag are stored as an
+# id into the tag_keys table, the view joins them back in.
+create_tag_table(conn, 'nodes_tags')
 
-# commit the changes
-conn.commit()
-
-# Read in the csv file as a dictionary, format the data as a list of tuples:
+# Read in the csv file as a dictionary, format the data as a stream of tuples
+# with the key and type replaced by their tag_keys id:
+tag_codes = TagCodes(conn)
 with open('nodes_tags.csv', 'rb') as fin:
     dr = csv.DictReader(fin) # comma is default limiter
-    to_db = [(i['id'], i['key'], i['value'].decode("utf-8"), i['type']) for i in dr]
+    to_db = (tag_codes.encode((i['id'], i['key'].decode("utf-8"), i['value'].decode("utf-8"), i['type'].decode("utf-8"))) for i in dr)
 
-# insert the formatted data
-cur.executemany("INSERT INTO nodes_tags(id, key, value,type) VALUES (?, ?, ?, ?);", to_db)
-# commit the changes
-conn.commit()
+    # insert the formatted data a chunk at a time and commit the changes
+    for chunk in chunked(to_db):
+        cur.executemany(insert_sql('nodes_tags'), chunk)
+        conn.commit()
+print "Peak RSS: {0:.1f} MB".format(peak_rss_mb())
 
 
 cur.execute('SELECT * FROM nodes_tags')
-all_rows = cur.fetchall()
+# Only fetch the rows that get printed
+all_rows = cur.fetchmany(100)
 print('1):')
-for i, row in enumerate(all_rows):
-    if i < 100:
-        print row
-    else:
-        break
+for row in all_rows:
+    print row
 #pprint(all_rows)
 
 conn.close()
@@ -1327,25 +3552,24 @@ cur.execute('''
 # commit the changes
 conn.commit()
 
-# Read in the csv file as a dictionary, format the data as a list of tuples:
+# Read in the csv file as a dictionary, format the data as a stream of tuples:
 with open('ways.csv', 'rb') as fin:
     dr = csv.DictReader(fin) # comma is default limiter
-    to_db = [(i['id'],  i['user'].decode("utf-8"), i['uid'], i['version'].decode("utf-8"), i['changeset'], i['timestamp'].decode("utf-8")) for i in dr]
+    to_db = ((i['id'],  i['user'].decode("utf-8"), i['uid'], i['version'].decode("utf-8"), i['changeset'], i['timestamp'].decode("utf-8")) for i in dr)
 
-# insert the formatted data
-cur.executemany("INSERT INTO ways(id, user, uid, version, changeset, timestamp) VALUES (?, ?, ?, ?, ?, ?);", to_db)
-# commit the changes
-conn.commit()
+    # insert the formatted data a chunk at a time and commit the changes
+    for chunk in chunked(to_db):
+        cur.executemany("INSERT INTO ways(id, user, uid, version, changeset, timestamp) VALUES (?, ?, ?, ?, ?, ?);", chunk)
+        conn.commit()
+print "Peak RSS: {0:.1f} MB".format(peak_rss_mb())
 
 
 cur.execute('SELECT * FROM ways')
-all_rows = cur.fetchall()
+# Only fetch the rows that get printed
+all_rows = cur.fetchmany(100)
 print('1):')
-for i, row in enumerate(all_rows):
-    if i < 100:
-        print row
-    else:
-        break
+for row in all_rows:
+    print row
 #pprint(all_rows)
 
 conn.close()
@@ -1384,25 +3608,24 @@ cur.execute('''
 # commit the changes
 conn.commit()
 
-# Read in the csv file as a dictionary, format the data as a list of tuples:
+# Read in the csv file as a dictionary, format the data as a stream of tuples:
 with open('ways_nodes.csv', 'rb') as fin:
     dr = csv.DictReader(fin) # comma is default limiter
-    to_db = [(i['id'],  i['node_id'], i['position']) for i in dr]
+    to_db = ((i['id'],  i['node_id'], i['position']) for i in dr)
 
-# insert the formatted data
-cur.executemany("INSERT INTO ways_nodes(id, node_id, position) VALUES (?, ?, ?);", to_db)
-# commit the changes
-conn.commit()
+    # insert the formatted data a chunk at a time and commit the changes
+    for chunk in chunked(to_db):
+        cur.executemany("INSERT INTO ways_nodes(id, node_id, position) VALUES (?, ?, ?);", chunk)
+        conn.commit()
+print "Peak RSS: {0:.1f} MB".format(peak_rss_mb())
 
 
 cur.execute('SELECT * FROM ways_nodes')
-all_rows = cur.fetchall()
+# Only fetch the rows that get printed
+all_rows = cur.fetchmany(100)
 print('1):')
-for i, row in enumerate(all_rows):
-    if i < 100:
-        print row
-    else:
-        break
+for row in all_rows:
+    print row
 #pprint(all_rows)
 
 conn.close()
@@ -1427,45 +3650,1170 @@ WAY_TAGS_PATH = "ways_tags.csv"
 # Get a cursor object
 cur = conn.cursor()
 
-# Before creating the table, drop the table if it already exists
-cur.execute('DROP TABLE IF EXISTS ways_tags')
-conn.commit()
-
-# Create the table, specifying the column names and data types:
-cur.execute('''
-    CREATE TABLE ways_tags(id INTEGER references ways, 
-    key TEXT, 
-    value TEXT, 
-    type TEXT)
-    ''')
+# Drop and recreate the table the tags are stored in, ways_tags_coded, and
+# the ways_tags view over it.  The key and type of each tag are stored as an
+# id into the tag_keys table, the view joins them back in.
+create_tag_table(conn, 'ways_tags')
 
-# commit the changes
-conn.commit()
-
-# Read in the csv file as a dictionary, format the data as a list of tuples:
+# Read in the csv file as a dictionary, format the data as a stream of tuples
+# with the key and type replaced by their tag_keys id:
+tag_codes = TagCodes(conn)
 with open('ways_tags.csv', 'rb') as fin:
     dr = csv.DictReader(fin) # comma is default limiter
-    to_db = [(i['id'],  i['key'].decode("utf-8"), i['value'].decode("utf-8"), i['type'].decode("utf-8")) for i in dr]
+    to_db = (tag_codes.encode((i['id'], i['key'].decode("utf-8"), i['value'].decode("utf-8"), i['type'].decode("utf-8"))) for i in dr)
 
-# insert the formatted data
-cur.executemany("INSERT INTO ways_tags(id, key, value, type) VALUES (?, ?, ?, ?);", to_db)
-# commit the changes
-conn.commit()
+    # insert the formatted data a chunk at a time and commit the changes
+    for chunk in chunked(to_db):
+        cur.executemany(insert_sql('ways_tags'), chunk)
+        conn.commit()
+print "Peak RSS: {0:.1f} MB".format(peak_rss_mb())
 
 
 cur.execute('SELECT * FROM ways_tags')
-all_rows = cur.fetchall()
+# Only fetch the rows that get printed
+all_rows = cur.fetchmany(100)
 print('1):')
-for i, row in enumerate(all_rows):
-    if i < 100:
-        print row
-    else:
-        break
+for row in all_rows:
+    print row
 #pprint(all_rows)
 
 conn.close()
 
 
+# In[ ]:
+
+# Build the secondary indexes and check the exploration queries use them
+# Run this after loading the tables with the cells above (bulk_import and
+# process_map(..., output='sqlite') already build them).  EXPLAIN QUERY PLAN
+# shows how sqlite runs each query; a line like 'SCAN nodes_tags_coded'
+# without 'USING ... INDEX' means a full table scan.
+import re
+import sqlite3
+from collections import OrderedDict
+
+# The user the per-user reports look at
+REPORT_USER = 'Tomash Pilshchik'
+
+# The queries from the exploration cells below, as (query, parameters).
+# The counts come from the summary tables create_indexes builds, except the
+# per-user key counts which group the tags of one user's elements.  Those
+# join the coded tables with CROSS JOIN, which keeps sqlite to that order:
+# the user's elements from the user index first, then their tags by id.
+# Their parameters are a function, so they read REPORT_USER when they run.
+REPORT_QUERIES = OrderedDict([
+    ('postcodes', ('''
+        select value, total from tag_value_counts
+        where element='node' and key='postcode' order by total desc;
+        ''', ())),
+    ('amenities', ('''
+        select value, total from tag_value_counts
+        where element='node' and key='amenity' order by total desc;
+        ''', ())),
+    ('top_users', ('''
+        select user, nodes + ways as total from user_counts
+        order by total desc
+        limit 10;
+        ''', ())),
+    ('user_node_keys', ('''
+        select tag_keys.key, count(*) as total
+        from nodes
+        cross join nodes_tags_coded on nodes_tags_coded.id = nodes.id
+        cross join tag_keys on tag_keys.id = nodes_tags_coded.key_id
+        where nodes.user=?
+        group by tag_keys.key
+        order by total desc;
+        ''', lambda: (REPORT_USER,))),
+    ('user_way_keys', ('''
+        select tag_keys.key, count(*) as total
+        from ways
+        cross join ways_tags_coded on ways_tags_coded.id = ways.id
+        cross join tag_keys on tag_keys.id = ways_tags_coded.key_id
+        where ways.user=?
+        group by tag_keys.key
+        order by total desc;
+        ''', lambda: (REPORT_USER,))),
+    ('node_tag_keys', ('''
+        select key, total from tag_key_counts
+        where element='node' order by total desc;
+        ''', ())),
+    ('way_tag_keys', ('''
+        select key, total from tag_key_counts
+        where element='way' order by total desc;
+        ''', ())),
+    ('highway_names', ('''
+        select value, total from tag_value_counts
+        where element='way' and key='name' order by total desc;
+        ''', ())),
+])
+
+def report_query(name, params=None, queries=REPORT_QUERIES):
+    """The query of a report and its parameters, its own unless params are given"""
+    sql, default_params = queries[name]
+    if params is None:
+        params = default_params() if callable(default_params) else default_params
+    return sql, params
+
+# A SCAN of one of the tables the data is loaded into reads all of it, the
+# table itself or, with USING INDEX, every entry of one of its indexes
+FULL_SCAN = re.compile(r'^SCAN (?:TABLE )?(nodes|nodes_tags|nodes_tags_coded|ways|ways_nodes|ways_tags|ways_tags_coded)\b')
+
+# A scan of tag_keys followed by a search of a coded tag table looks up the
+# tags of every key in turn, which reads the whole tag table through its index
+KEY_SCAN = re.compile(r'^SCAN (?:TABLE )?tag_keys\b')
+CODED_SEARCH = re.compile(r'^SEARCH (?:TABLE )?(nodes_tags_coded|ways_tags_coded)\b')
+
+PLAN_INDEX = re.compile(r'USING (?:COVERING )?INDEX (\w+)')
+
+# The indexes each of the queries that still read the loaded tables has to use
+REPORT_INDEXES = OrderedDict([
+    ('user_node_keys', ['nodes_user', 'nodes_tags_id']),
+    ('user_way_keys', ['ways_user', 'ways_tags_id']),
+])
+
+def query_plan(conn, query, params=()):
+    """Return the detail lines of EXPLAIN QUERY PLAN for a query"""
+    return [row[-1] for row in conn.execute('EXPLAIN QUERY PLAN ' + query, params)]
+
+def scanned_tables(plan):
+    """The tables a query plan reads in full"""
+    tables = [m.group(1) for m in (FULL_SCAN.match(line) for line in plan) if m]
+    for i, line in enumerate(plan):
+        if KEY_SCAN.match(line) and any(CODED_SEARCH.match(later) for later in plan[i + 1:]):
+            tables.append('tag_keys')
+    return tables
+
+def plan_indexes(plan):
+    """The names of the indexes a query plan uses"""
+    return [m.group(1) for m in (PLAN_INDEX.search(line) for line in plan) if m]
+
+def check_query_plans(conn, queries=REPORT_QUERIES):
+    """Print the plan of each query and return the tables each one scans in full"""
+    full_scans = OrderedDict()
+    for name in queries:
+        query, params = report_query(name, queries=queries)
+        plan = query_plan(conn, query, params)
+        full_scans[name] = scanned_tables(plan)
+        print name
+        for line in plan:
+            print "    " + line
+    return full_scans
+
+def test():
+    conn = sqlite3.connect(DB_PATH)
+    create_indexes(conn)
+    full_scans = check_query_plans(conn)
+    for name, tables in full_scans.iteritems():
+        assert not tables, "{0} scans {1} in full".format(name, ', '.join(tables))
+    for name, indexes in REPORT_INDEXES.iteritems():
+        query, params = report_query(name)
+        used = plan_indexes(query_plan(conn, query, params))
+        missing = [index for index in indexes if index not in used]
+        assert not missing, "{0} doesn't use {1}".format(name, ', '.join(missing))
+    
+    # The order the view query could take before is caught
+    assert scanned_tables(['SCAN tag_keys', 'SEARCH nodes_tags_coded USING INDEX nodes_tags_key_value (key_id=?)',
+                           'BLOOM FILTER ON nodes (id=?)']) == ['tag_keys']
+    assert scanned_tables(['SCAN nodes_tags_coded USING INDEX nodes_tags_key_value']) == ['nodes_tags_coded']
+    conn.close()
+
+
+if __name__ == '__main__':
+    test()
+
+
+# In[ ]:
+
+# This block brings west-springfield.db up to date without rebuilding it,
+# from an osmChange (.osc) diff or from a newer extract of the same area.
+# Only the nodes and ways whose version changed are shaped and rewritten,
+# everything else in the database is left as it is.
+import operator
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from collections import OrderedDict
+
+# The tables each shaped section of a node or way goes to
+ELEMENT_TABLES = OrderedDict([
+    ('node', OrderedDict([('node', 'nodes'), ('node_tags', 'nodes_tags')])),
+    ('way', OrderedDict([('way', 'ways'), ('way_nodes', 'ways_nodes'), ('way_tags', 'ways_tags')])),
+])
+
+class IncrementalUpdate(object):
+    """Replace or delete single nodes and ways in an existing database"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.inserts = dict((table, insert_sql(table)) for table in SQL_TABLES)
+        self.tag_codes = TagCodes(conn)
+        self.row_values = dict((table, row_values(table, self.tag_codes)) for table in SQL_TABLES)
+        self.counts = OrderedDict([('created', 0), ('modified', 0), ('deleted', 0), ('unchanged', 0)])
+        
+        # Databases loaded before the spatial index have no R*Tree to keep up
+        self.spatial = conn.execute("SELECT count(*) FROM sqlite_master WHERE name = 'nodes_rtree'").fetchone()[0] > 0
+        self.search = conn.execute("SELECT count(*) FROM sqlite_master WHERE name = 'tags_search'").fetchone()[0] > 0
+
+    def stored_version(self, tag, element_id):
+        row = self.conn.execute('SELECT version FROM {0} WHERE id = ?'.format(ELEMENT_TABLES[tag][tag]),
+                                (int(element_id),)).fetchone()
+        return None if row is None else int(row[0])
+
+    def remove(self, tag, element_id):
+        if self.search:
+            remove_from_search_index(self.conn, tag, element_id)
+        for table in ELEMENT_TABLES[tag].itervalues():
+            self.conn.execute('DELETE FROM {0} WHERE id = ?'.format(storage_table(table)), (int(element_id),))
+
+    def upsert(self, element, stored):
+        """Shape element and replace its rows, stored is the version in the database or None"""
+        el = shape_element(element)
+        if stored is not None:
+            self.remove(element.tag, element.attrib['id'])
+        for section, table in ELEMENT_TABLES[element.tag].iteritems():
+            rows = el[section] if isinstance(el[section], list) else [el[section]]
+            self.conn.executemany(self.inserts[table], map(self.row_values[table], rows))
+        self.update_spatial(element.tag, element.attrib['id'])
+        if self.search:
+            add_to_search_index(self.conn, element.tag, element.attrib['id'])
+        self.counts['created' if stored is None else 'modified'] += 1
+
+    def delete(self, tag, element_id):
+        if self.stored_version(tag, element_id) is not None:
+            self.remove(tag, element_id)
+            self.update_spatial(tag, element_id)
+            self.counts['deleted'] += 1
+
+    def update_spatial(self, tag, element_id):
+        if self.spatial:
+            update_spatial_index(self.conn, tag, element_id)
+
+
+def apply_changes(osc_file, db_path=DB_PATH, backend=None):
+    """Apply the node and way changes of an osmChange file to the database
+
+    Created and modified elements are written when their version is newer
+    than the stored one, deleted ones are removed.  Everything happens in
+    one transaction.  Returns the counts of created, modified, deleted and
+    unchanged elements.
+    """
+    conn = sqlite3.connect(db_path)
+    update = IncrementalUpdate(conn)
+    try:
+        with conn:
+            context = iter(iterparse(osc_file, events=('start', 'end'), backend=backend))
+            _, root = next(context)
+            action = None
+            for event, elem in context:
+                if elem.tag in ('create', 'modify', 'delete'):
+                    if event == 'start':
+                        action = elem
+                    else:
+                        action = None
+                        root.clear()
+                elif event == 'end' and action is not None and elem.tag in ELEMENT_TABLES:
+                    if action.tag == 'delete':
+                        update.delete(elem.tag, elem.attrib['id'])
+                    else:
+                        stored = update.stored_version(elem.tag, elem.attrib['id'])
+                        if stored is None or int(elem.attrib['version']) > stored:
+                            update.upsert(elem, stored)
+                        else:
+                            update.counts['unchanged'] += 1
+                    
+                    # The action element holds the changes until it ends
+                    action.clear()
+    finally:
+        conn.close()
+    return update.counts
+
+def update_from_extract(osm_file, db_path=DB_PATH, backend=None):
+    """Bring the database in line with a newer extract of the same area
+
+    Nodes and ways whose version differs from the stored one are rewritten,
+    new ones are added and the ones missing from the extract are deleted.
+    Only the stored ids and versions are held in memory.  Returns the
+    counts of created, modified, deleted and unchanged elements.
+    """
+    conn = sqlite3.connect(db_path)
+    update = IncrementalUpdate(conn)
+    try:
+        with conn:
+            versions = dict((tag, dict(conn.execute('SELECT id, version FROM {0}'.format(tables[tag]))))
+                            for tag, tables in ELEMENT_TABLES.iteritems())
+            for element in get_element(osm_file, tags=('node', 'way'), backend=backend):
+                stored = versions[element.tag].pop(int(element.attrib['id']), None)
+                if stored is not None and int(stored) == int(element.attrib['version']):
+                    update.counts['unchanged'] += 1
+                else:
+                    update.upsert(element, None if stored is None else int(stored))
+            
+            for tag, missing in versions.iteritems():
+                for element_id in missing:
+                    update.remove(tag, element_id)
+                    update.update_spatial(tag, element_id)
+                    update.counts['deleted'] += 1
+    finally:
+        conn.close()
+    return update.counts
+
+
+def summary_drift(conn):
+    """The summary tables whose rows differ from counting the tables again"""
+    return [name for name, (_, select) in SUMMARY_TABLES.iteritems()
+            if sorted(conn.execute('SELECT * FROM ' + name)) != sorted(conn.execute(select))]
+
+def search_drift(conn):
+    """The numbers of searchable tags missing from tags_search and of its rows with no tag"""
+    indexed = set(conn.execute('SELECT rowid, value, k, element, id FROM tags_search'))
+    tags = set(row for element in SEARCH_SOURCES for row in conn.execute(search_select_sql(element)))
+    return len(tags - indexed), len(indexed - tags)
+
+def test():
+    # Work on a copy of the database with a small change file made from it
+    work_dir = tempfile.mkdtemp(prefix='osm-update-')
+    try:
+        db_path = os.path.join(work_dir, os.path.basename(DB_PATH))
+        shutil.copy(DB_PATH, db_path)
+        conn = sqlite3.connect(db_path)
+        node = conn.execute('SELECT id, lat, lon, user, uid, version, changeset, timestamp FROM nodes LIMIT 1').fetchone()
+        way_id = conn.execute('SELECT id FROM ways LIMIT 1').fetchone()[0]
+        conn.close()
+        
+        attrib = dict(zip(NODE_FIELDS, [unicode(value) for value in node]))
+        modified = ET.Element('node', dict(attrib, version=unicode(int(node[5]) + 1)))
+        ET.SubElement(modified, 'tag', {'k': 'amenity', 'v': 'cafe'})
+        created = ET.Element('node', dict(attrib, id=u'-1'))
+        changes = ET.Element('osmChange', {'version': '0.6'})
+        ET.SubElement(changes, 'create').append(created)
+        ET.SubElement(changes, 'modify').append(modified)
+        ET.SubElement(ET.SubElement(changes, 'delete'), 'way', {'id': unicode(way_id), 'version': u'1'})
+        osc_file = os.path.join(work_dir, 'changes.osc')
+        ET.ElementTree(changes).write(osc_file, encoding='utf-8')
+        
+        start = time.time()
+        counts = apply_changes(osc_file, db_path)
+        print "Applied changes in {0:.2f}s: {1}".format(time.time() - start, dict(counts))
+        assert counts == OrderedDict([('created', 1), ('modified', 1), ('deleted', 1), ('unchanged', 0)])
+        
+        conn = sqlite3.connect(db_path)
+        assert conn.execute("SELECT value FROM nodes_tags WHERE id = ? AND key = 'amenity'", (node[0],)).fetchall() == [(u'cafe',)]
+        assert conn.execute('SELECT count(*) FROM nodes WHERE id = -1').fetchone() == (1,)
+        assert conn.execute('SELECT count(*) FROM ways_nodes WHERE id = ?', (way_id,)).fetchone() == (0,)
+        assert not summary_drift(conn), summary_drift(conn)
+        conn.close()
+        
+        # Applying the same changes again is a no-op
+        assert apply_changes(osc_file, db_path)['unchanged'] == 2
+        
+        # VACUUM can renumber the tag rows after the deleted way, the search
+        # rows of a way changed after that still have to be replaced
+        conn = sqlite3.connect(db_path)
+        conn.execute('VACUUM')
+        way = conn.execute("""
+            SELECT id, user, uid, version, changeset, timestamp FROM ways
+            WHERE id IN (SELECT id FROM ways_tags WHERE key = 'name' AND type = 'regular')
+            ORDER BY id DESC LIMIT 1
+            """).fetchone()
+        refs = conn.execute('SELECT node_id FROM ways_nodes WHERE id = ? ORDER BY position', (way[0],)).fetchall()
+        tags = conn.execute('SELECT key, value, type FROM ways_tags WHERE id = ?', (way[0],)).fetchall()
+        conn.close()
+        
+        attrib = dict(zip(['id', 'user', 'uid', 'version', 'changeset', 'timestamp'], [unicode(value) for value in way]))
+        modified = ET.Element('way', dict(attrib, version=unicode(int(way[3]) + 1)))
+        for (ref,) in refs:
+            ET.SubElement(modified, 'nd', {'ref': unicode(ref)})
+        for key, value, tag_type in tags:
+            if key == 'name' and tag_type == 'regular':
+                value = u'Vacuum Street'
+            ET.SubElement(modified, 'tag', {'k': key if tag_type == 'regular' else tag_type + ':' + key, 'v': value})
+        changes = ET.Element('osmChange', {'version': '0.6'})
+        ET.SubElement(changes, 'modify').append(modified)
+        ET.ElementTree(changes).write(osc_file, encoding='utf-8')
+        assert apply_changes(osc_file, db_path)['modified'] == 1
+        
+        conn = sqlite3.connect(db_path)
+        assert search_drift(conn) == (0, 0), search_drift(conn)
+        conn.close()
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    test()
+
+
+# In[ ]:
+
+# This block assembles the geometry of every way from ways_nodes.csv and the
+# node store that process_map saves.  Instead of looking the nodes of each
+# way up one at a time, all the refs are sorted by node id once and resolved
+# in a single merge pass over the sorted ids of the store.  Closed ways, whose
+# first and last node are the same, become polygons with an area, the others
+# lines, and every way gets its length.  The test checks every way against
+# a join on the database loaded above.
+import array
+import csv
+import itertools
+import math
+import operator
+import sqlite3
+import time
+
+WAY_GEOMETRY_PATH = "ways_geometry.csv"
+WAY_GEOMETRY_FIELDS = ['id', 'closed', 'nodes', 'missing', 'length', 'area', 'wkt']
+
+# Mean radius of the earth in metres, for the lengths and areas
+EARTH_RADIUS = 6371008.8
+
+def read_way_refs(path=WAY_NODES_PATH):
+    """Read ways_nodes.csv into typed arrays
+
+    Returns the way ids, the start of each way in refs (with the end of
+    the last one appended) and the node refs of all the ways in order.
+    """
+    way_ids = array.array(NODE_ID_TYPECODE)
+    starts = array.array(NODE_ID_TYPECODE)
+    refs = array.array(NODE_ID_TYPECODE)
+    with open(path, 'rb') as fin:
+        reader = csv.reader(fin)
+        header = next(reader)
+        assert header == WAY_NODES_FIELDS, "{0} columns don't match ways_nodes".format(path)
+        
+        # process_map writes the nodes of a way together, in position order
+        for way_id, rows in itertools.groupby(reader, operator.itemgetter(0)):
+            way_ids.append(int(way_id))
+            starts.append(len(refs))
+            refs.extend(int(row[1]) for row in rows)
+    starts.append(len(refs))
+    return way_ids, starts, refs
+
+def resolve_refs(refs, store):
+    """Look up the coordinates of every ref with one merge pass over the store
+
+    Returns lat and lon arrays parallel to refs, fixed point like the
+    store, and a bytearray that is 1 where the ref was found.
+    """
+    n = len(refs)
+    lats = array.array(NODE_COORD_TYPECODE, [0]) * n
+    lons = array.array(NODE_COORD_TYPECODE, [0]) * n
+    found = bytearray(n)
+    
+    # A loaded store is memory mapped, copy the arrays for the scan
+    ids, store_lats, store_lons = [values if isinstance(values, array.array) else array.array(typecode, values.tostring())
+                                   for values, typecode in ((store.ids, NODE_ID_TYPECODE),
+                                                            (store.lats, NODE_COORD_TYPECODE),
+                                                            (store.lons, NODE_COORD_TYPECODE))]
+    count = len(ids)
+    j = 0
+    for i in sorted(xrange(n), key=refs.__getitem__):
+        ref = refs[i]
+        while j < count and ids[j] < ref:
+            j += 1
+        if j == count:
+            break
+        if ids[j] == ref:
+            lats[i] = store_lats[j]
+            lons[i] = store_lons[j]
+            found[i] = 1
+    return lats, lons, found
+
+def path_length(points):
+    """Length in metres along (lat, lon) points in degrees, by the haversine formula"""
+    length = 0.0
+    for (lat1, lon1), (lat2, lon2) in itertools.izip(points, itertools.islice(points, 1, None)):
+        phi1, phi2 = math.radians(lat1), math.radians(lat2)
+        a = (math.sin((phi2 - phi1) / 2) ** 2 +
+             math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2)
+        length += 2 * EARTH_RADIUS * math.asin(math.sqrt(min(a, 1.0)))
+    return length
+
+def ring_area(points):
+    """Area in square metres of a closed ring of (lat, lon) points
+
+    The ring is projected onto a plane around its mean latitude, which is
+    close enough at the size of a building or a park.
+    """
+    lat0 = math.radians(sum(lat for lat, _ in points) / len(points))
+    xy = [(math.radians(lon) * math.cos(lat0) * EARTH_RADIUS, math.radians(lat) * EARTH_RADIUS) for lat, lon in points]
+    twice_area = sum(x1 * y2 - x2 * y1 for (x1, y1), (x2, y2) in itertools.izip(xy, xy[1:]))
+    return abs(twice_area) / 2
+
+def geometry_wkt(points, polygon):
+    """The points as a WKT LINESTRING or POLYGON, lon before lat"""
+    if len(points) < 2:
+        return ''
+    coords = ', '.join('{0:.7f} {1:.7f}'.format(lon, lat) for lat, lon in points)
+    return ('POLYGON (({0}))' if polygon else 'LINESTRING ({0})').format(coords)
+
+def way_geometries(store, ways_nodes_path=WAY_NODES_PATH):
+    """Yield the geometry of each way as a dict of WAY_GEOMETRY_FIELDS
+
+    Nodes missing from the store, usually outside the extract, are left
+    out of the coordinates and counted in 'missing'.  A closed way is
+    only written as a polygon when none of its nodes are missing.
+    """
+    way_ids, starts, refs = read_way_refs(ways_nodes_path)
+    lats, lons, found = resolve_refs(refs, store)
+    scale = float(NODE_COORD_SCALE)
+    for k, way_id in enumerate(way_ids):
+        start, end = starts[k], starts[k + 1]
+        points = [(lats[i] / scale, lons[i] / scale) for i in xrange(start, end) if found[i]]
+        missing = end - start - len(points)
+        closed = end - start >= 4 and refs[start] == refs[end - 1]
+        polygon = closed and not missing
+        yield {'id': way_id,
+               'closed': closed,
+               'nodes': end - start,
+               'missing': missing,
+               'length': round(path_length(points), 2),
+               'area': round(ring_area(points), 2) if polygon else None,
+               'wkt': geometry_wkt(points, polygon)}
+
+def write_way_geometry(store_path=NODE_STORE_PATH, ways_nodes_path=WAY_NODES_PATH, out_path=WAY_GEOMETRY_PATH):
+    """Write the geometry of every way to out_path and return the number of ways"""
+    store = NodeStore.load(store_path)
+    count = 0
+    try:
+        with open(out_path, 'wb') as fout:
+            writer = csv.DictWriter(fout, WAY_GEOMETRY_FIELDS)
+            writer.writeheader()
+            for geometry in way_geometries(store, ways_nodes_path):
+                writer.writerow(geometry)
+                count += 1
+    finally:
+        store.close()
+    return count
+
+
+def sql_way_points(conn, way_id):
+    """The (lat, lon) points of a way with one join, the way it was done before"""
+    return conn.execute('''
+        SELECT lat, lon FROM ways_nodes JOIN nodes ON nodes.id = ways_nodes.node_id
+        WHERE ways_nodes.id = ? ORDER BY position
+        ''', (way_id,)).fetchall()
+
+def test():
+    store = NodeStore.load(NODE_STORE_PATH)
+    try:
+        # Time resolving the nodes of every way, against a join per way below
+        start = time.time()
+        resolve_refs(read_way_refs()[2], store)
+        bulk = time.time() - start
+        geometries = list(way_geometries(store))
+    finally:
+        store.close()
+    
+    # Every way has to match a join per way against the database
+    conn = sqlite3.connect(DB_PATH)
+    start = time.time()
+    per_way = [sql_way_points(conn, geometry['id']) for geometry in geometries]
+    joins = time.time() - start
+    conn.close()
+    for geometry, points in zip(geometries, per_way):
+        assert geometry['nodes'] - geometry['missing'] == len(points), geometry['id']
+        assert abs(geometry['length'] - path_length(points)) < 0.1, geometry['id']
+    
+    print "{0} ways, {1} closed, {2} with missing nodes".format(
+        len(geometries), sum(g['closed'] for g in geometries), sum(1 for g in geometries if g['missing']))
+    print "  merge pass:    {0:6.2f} s".format(bulk)
+    print "  join per way:  {0:6.2f} s".format(joins)
+
+
+if __name__ == '__main__':
+    print "{0} way geometries written to {1}".format(write_way_geometry(), WAY_GEOMETRY_PATH)
+    test()
+
+
+# In[ ]:
+
+# This block answers "what's near here" questions from the R*Tree tables that
+# create_indexes builds: everything in a bounding box, everything within a
+# radius of a point, and the k nearest nodes or ways.  The R*Tree finds the
+# candidates, so the nodes and ways tables are only read by primary key and
+# the tags by the id index.  Results come back as dicts with their tags.
+import math
+import sqlite3
+import time
+
+# Metres per degree of latitude, for turning a radius into a box
+METRES_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+
+# Largest radius nearest() searches out to, half way round the earth
+MAX_SEARCH_RADIUS = 180 * METRES_PER_DEGREE
+
+NODES_IN_BOX_SQL = '''
+    SELECT nodes.id, nodes.lat, nodes.lon
+    FROM nodes_rtree CROSS JOIN nodes ON nodes.id = nodes_rtree.id
+    WHERE nodes_rtree.min_lat <= ? AND nodes_rtree.max_lat >= ?
+    AND nodes_rtree.min_lon <= ? AND nodes_rtree.max_lon >= ?
+    AND nodes.lat BETWEEN ? AND ? AND nodes.lon BETWEEN ? AND ?
+    '''
+WAYS_IN_BOX_SQL = '''
+    SELECT id, min_lat, max_lat, min_lon, max_lon FROM ways_rtree
+    WHERE min_lat <= ? AND max_lat >= ? AND min_lon <= ? AND max_lon >= ?
+    '''
+
+# Ids per IN (...) list when fetching tags, under sqlite's 999 variables
+TAG_FETCH_IDS = 500
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Distance in metres between two points in degrees"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2 +
+         math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(min(a, 1.0)))
+
+def box_around(lat, lon, metres):
+    """The (min_lat, min_lon, max_lat, max_lon) box that holds a circle"""
+    dlat = metres / METRES_PER_DEGREE
+    cos_lat = math.cos(math.radians(lat))
+    dlon = 180.0 if cos_lat < 1e-9 else min(180.0, dlat / cos_lat)
+    return lat - dlat, lon - dlon, lat + dlat, lon + dlon
+
+def tag_key(key, tag_type):
+    """The original k of a tag row, 'addr:street' for key 'street' and type 'addr'"""
+    return key if tag_type == 'regular' else tag_type + ':' + key
+
+
+class SpatialIndex(object):
+    """Bounding box, radius and nearest queries over the nodes and ways of a database
+
+    kinds limits a query to 'node' or 'way'.  Nodes come back with their
+    lat and lon, ways with the bounds of their nodes, and each result has
+    its 'tags' as a {k: v} dict.  Distances to ways are to the nearest
+    point of their bounds.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def bbox(self, min_lat, min_lon, max_lat, max_lon, kinds=('node', 'way')):
+        """Every node and way inside or overlapping the box"""
+        results = []
+        if 'node' in kinds:
+            for node_id, lat, lon in self.conn.execute(NODES_IN_BOX_SQL, (max_lat, min_lat, max_lon, min_lon,
+                                                                           min_lat, max_lat, min_lon, max_lon)):
+                results.append({'type': 'node', 'id': node_id, 'lat': lat, 'lon': lon})
+        if 'way' in kinds:
+            for way_id, way_min_lat, way_max_lat, way_min_lon, way_max_lon in self.conn.execute(
+                    WAYS_IN_BOX_SQL, (max_lat, min_lat, max_lon, min_lon)):
+                results.append({'type': 'way', 'id': way_id,
+                                'bounds': (way_min_lat, way_min_lon, way_max_lat, way_max_lon)})
+        self.add_tags(results)
+        return results
+
+    def radius(self, lat, lon, metres, kinds=('node', 'way')):
+        """Every node and way within metres of a point, nearest first, with its 'distance'"""
+        results = []
+        for result in self.bbox(*box_around(lat, lon, metres), kinds=kinds):
+            result['distance'] = self.distance(result, lat, lon)
+            if result['distance'] <= metres:
+                results.append(result)
+        results.sort(key=lambda result: result['distance'])
+        return results
+
+    def nearest(self, lat, lon, k=10, kinds=('node', 'way'), start_radius=100.0):
+        """The k nearest nodes and ways to a point, nearest first
+
+        The radius is doubled until it holds k results; anything nearer
+        than the kth one is then inside it too.
+        """
+        metres = start_radius
+        while True:
+            results = self.radius(lat, lon, metres, kinds)
+            if len(results) >= k or metres >= MAX_SEARCH_RADIUS:
+                return results[:k]
+            metres *= 2
+
+    @staticmethod
+    def distance(result, lat, lon):
+        if result['type'] == 'node':
+            return haversine(lat, lon, result['lat'], result['lon'])
+        min_lat, min_lon, max_lat, max_lon = result['bounds']
+        return haversine(lat, lon, min(max(lat, min_lat), max_lat), min(max(lon, min_lon), max_lon))
+
+    def add_tags(self, results):
+        """Fill in the tags of the results, a query per TAG_FETCH_IDS ids"""
+        for kind, view in (('node', 'nodes_tags'), ('way', 'ways_tags')):
+            by_id = {}
+            for result in results:
+                if result['type'] == kind:
+                    result['tags'] = {}
+                    by_id[result['id']] = result['tags']
+            ids = by_id.keys()
+            for i in xrange(0, len(ids), TAG_FETCH_IDS):
+                chunk = ids[i:i + TAG_FETCH_IDS]
+                query = 'SELECT id, key, value, type FROM {0} WHERE id IN ({1})'.format(view, ', '.join('?' * len(chunk)))
+                for element_id, key, value, tag_type in self.conn.execute(query, chunk):
+                    by_id[element_id][tag_key(key, tag_type)] = value
+
+
+def test():
+    conn = sqlite3.connect(DB_PATH)
+    index = SpatialIndex(conn)
+    lat, lon = conn.execute('SELECT lat, lon FROM nodes ORDER BY id LIMIT 1 OFFSET 1000').fetchone()
+    nodes = conn.execute('SELECT id, lat, lon FROM nodes').fetchall()
+    
+    # The queries have to find the same nodes as a scan of the table
+    start = time.time()
+    found = sorted(result['id'] for result in index.radius(lat, lon, 2000, kinds=('node',)))
+    indexed = time.time() - start
+    start = time.time()
+    scanned = sorted(node_id for node_id, node_lat, node_lon in nodes if haversine(lat, lon, node_lat, node_lon) <= 2000)
+    scan = time.time() - start
+    assert found == scanned
+    nearest = index.nearest(lat, lon, k=5, kinds=('node',))
+    assert [result['id'] for result in nearest] == [node_id for _, node_id in
+                                                   sorted((haversine(lat, lon, node_lat, node_lon), node_id)
+                                                          for node_id, node_lat, node_lon in nodes)[:5]]
+    
+    # None of the queries scan the tables
+    plans = [query_plan(conn, NODES_IN_BOX_SQL, (0,) * 8), query_plan(conn, WAYS_IN_BOX_SQL, (0,) * 4)]
+    assert not [line for plan in plans for line in plan if FULL_SCAN.match(line)], plans
+    
+    ways = index.bbox(*box_around(lat, lon, 500))
+    print "{0} nodes within 2 km: R*Tree {1:.4f} s, scan {2:.4f} s".format(len(found), indexed, scan)
+    print "{0} nodes and ways within a 500 m box".format(len(ways))
+    for result in nearest:
+        print "  {0} {1} {2:.0f} m {3}".format(result['type'], result['id'], result['distance'], result['tags'])
+    conn.close()
+
+
+if __name__ == '__main__':
+    test()
+
+
+# In[ ]:
+
+# This block searches names and addresses through the FTS5 table that
+# create_indexes builds, instead of LIKE scans over the tag values.  Every
+# word of the query has to match, the last one as a prefix, and elements
+# come back best first by the bm25 rank FTS5 gives each match.
+import re
+import sqlite3
+import time
+
+SEARCH_WORD = re.compile(r'\w+', re.UNICODE)
+
+# An element can match on several tags and ranks by its best one.  The
+# matching keys and values are joined with a control character, which
+# can't appear in the XML the values come from.
+SEARCH_SEPARATOR = u'\x1f'
+SEARCH_SQL = '''
+    SELECT element, id, min(rank) AS best, group_concat(k, char(31)), group_concat(value, char(31))
+    FROM tags_search WHERE tags_search MATCH ? {0}
+    GROUP BY element, id ORDER BY best LIMIT ?
+    '''
+
+def search_query(text, prefix=True):
+    """The FTS5 query for the words of text, or None if it has no words"""
+    if not isinstance(text, unicode):
+        text = text.decode('utf-8')
+    
+    # Quoting each word keeps FTS5 from reading it as an operator
+    terms = ['"{0}"'.format(word) for word in SEARCH_WORD.findall(text)]
+    if not terms:
+        return None
+    if prefix:
+        terms[-1] += '*'
+    return u' '.join(terms)
+
+def search(conn, text, keys=None, limit=20, prefix=True):
+    """Nodes and ways whose name or address tags match text, best first
+
+    keys limits the match to some of SEARCH_KEYS, such as ['addr:street'].
+    Each result has the element type and id, its rank (lower is better)
+    and the (k, value) tags that matched.
+    """
+    query = search_query(text, prefix)
+    if query is None:
+        return []
+    where = ''
+    params = [query]
+    if keys:
+        where = 'AND k IN ({0})'.format(', '.join('?' * len(keys)))
+        params.extend(keys)
+    
+    # sqlite takes a negative limit as no limit
+    params.append(-1 if limit is None else limit)
+    results = []
+    for element, element_id, rank, ks, values in conn.execute(SEARCH_SQL.format(where), params):
+        results.append({'type': element, 'id': element_id, 'rank': rank,
+                        'matches': zip(ks.split(SEARCH_SEPARATOR), values.split(SEARCH_SEPARATOR))})
+    return results
+
+
+def test():
+    conn = sqlite3.connect(DB_PATH)
+    word = conn.execute("SELECT value FROM ways_tags WHERE key = 'name' AND type = 'regular' LIMIT 1").fetchone()[0].split()[0]
+    
+    # A word search finds the same elements as reading every searchable tag
+    start = time.time()
+    found = set((result['type'], result['id']) for result in search(conn, word, limit=None, prefix=False))
+    indexed = time.time() - start
+    expected = set()
+    start = time.time()
+    for element, view in (('node', 'nodes_tags'), ('way', 'ways_tags')):
+        for element_id, key, value, tag_type in conn.execute("SELECT id, key, value, type FROM {0} WHERE value LIKE ?".format(view),
+                                                             ('%' + word + '%',)):
+            if tag_key(key, tag_type) in SEARCH_KEYS and word.lower() in (w.lower() for w in SEARCH_WORD.findall(value)):
+                expected.add((element, element_id))
+    like = time.time() - start
+    assert found == expected, (word, len(found), len(expected))
+    
+    # Key filters only return matches on those keys
+    streets = search(conn, word, keys=['addr:street'], limit=None)
+    assert all(k == 'addr:street' for result in streets for k, _ in result['matches'])
+    
+    start = time.time()
+    prefixed = search(conn, word[:3])
+    prefix_time = time.time() - start
+    print "'{0}': {1} elements, FTS5 {2:.4f} s, LIKE scan {3:.4f} s".format(word, len(found), indexed, like)
+    print "'{0}*': top {1} in {2:.4f} s".format(word[:3], len(prefixed), prefix_time)
+    for result in prefixed[:5]:
+        print "  {0} {1} {2:.2f} {3}".format(result['type'], result['id'], result['rank'], result['matches'])
+    conn.close()
+
+
+if __name__ == '__main__':
+    test()
+
+
+# In[ ]:
+
+# This block is the query layer the report cells below run on.  Connections
+# to the database are opened read-only once per process and handed out from
+# a pool, each with its own prepared statement cache, so a report doesn't
+# reconnect, re-read the schema and start from a cold page cache every time.
+# Results are read into pandas a chunk of rows at a time.
+import Queue
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+
+# Connections per database, and prepared statements kept by each one
+POOL_SIZE = 4
+STATEMENT_CACHE_SIZE = 100
+
+# Rows fetched per DataFrame chunk
+FRAME_CHUNK_ROWS = 50000
+
+class ConnectionPool(object):
+    """Up to size read-only connections to a database, reused across queries
+
+    Connections are opened as they are first needed.  query_only makes
+    sqlite refuse any write through them, and check_same_thread is off
+    so a connection can go back to the pool from another thread.
+    """
+
+    def __init__(self, db_path=DB_PATH, size=POOL_SIZE, cached_statements=STATEMENT_CACHE_SIZE):
+        self.db_path = db_path
+        self.size = size
+        self.cached_statements = cached_statements
+        self.idle = Queue.LifoQueue()
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    def open(self):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, cached_statements=self.cached_statements)
+        conn.execute('PRAGMA query_only = ON')
+        return conn
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except Queue.Empty:
+            pass
+        with self.lock:
+            opening = self.opened < self.size
+            if opening:
+                self.opened += 1
+        if not opening:
+            return self.idle.get()
+        try:
+            return self.open()
+        except:
+            with self.lock:
+                self.opened -= 1
+            raise
+
+    def release(self, conn):
+        self.idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        """Close the idle connections"""
+        while True:
+            try:
+                conn = self.idle.get_nowait()
+            except Queue.Empty:
+                return
+            conn.close()
+            with self.lock:
+                self.opened -= 1
+
+
+# One pool per database and process, a forked process opens its own
+POOLS = {}
+POOLS_LOCK = threading.Lock()
+
+def get_pool(db_path=DB_PATH):
+    key = (os.getpid(), os.path.abspath(db_path))
+    with POOLS_LOCK:
+        if key not in POOLS:
+            POOLS[key] = ConnectionPool(db_path)
+        return POOLS[key]
+
+def query(sql, params=(), db_path=DB_PATH):
+    """All the rows of a query, run on a pooled connection"""
+    with get_pool(db_path).connection() as conn:
+        return conn.execute(sql, params).fetchall()
+
+def iter_frames(sql, params=(), db_path=DB_PATH, chunk_rows=FRAME_CHUNK_ROWS):
+    """Yield the result of a query as DataFrames of up to chunk_rows rows
+
+    The pooled connection is held until the last chunk has been read.  A
+    query with no rows yields one empty DataFrame with its columns.
+    """
+    with get_pool(db_path).connection() as conn:
+        cursor = conn.execute(sql, params)
+        columns = [description[0] for description in cursor.description]
+        empty = True
+        while True:
+            rows = cursor.fetchmany(chunk_rows)
+            if not rows:
+                break
+            empty = False
+            yield pd.DataFrame.from_records(rows, columns=columns)
+        if empty:
+            yield pd.DataFrame(columns=columns)
+
+def read_frame(sql, params=(), db_path=DB_PATH, chunk_rows=FRAME_CHUNK_ROWS):
+    """The result of a query as one DataFrame, read chunk_rows rows at a time"""
+    return pd.concat(iter_frames(sql, params, db_path, chunk_rows), ignore_index=True)
+
+def report(name, params=None, db_path=DB_PATH):
+    """One of the REPORT_QUERIES as a DataFrame, with its own parameters unless params are given"""
+    sql, params = report_query(name, params)
+    return read_frame(sql, params, db_path)
+
+
+def test():
+    # Every report matches the same query on a connection of its own
+    direct = sqlite3.connect(DB_PATH)
+    for name in REPORT_QUERIES:
+        sql, params = report_query(name)
+        assert [tuple(row) for row in report(name).itertuples(index=False)] == direct.execute(sql, params).fetchall(), name
+    
+    # Reading in small chunks gives the same frame
+    sql, params = report_query('highway_names')
+    assert read_frame(sql, params, chunk_rows=7).equals(read_frame(sql, params))
+    
+    # The pooled connections can't write
+    try:
+        query('DELETE FROM nodes')
+    except sqlite3.OperationalError:
+        pass
+    else:
+        raise AssertionError('a pooled connection wrote to the database')
+    
+    # All the reports, reconnecting for each one as the cells used to
+    runs = 10
+    start = time.time()
+    for _ in xrange(runs):
+        for name in REPORT_QUERIES:
+            sql, params = report_query(name)
+            db = sqlite3.connect(DB_PATH)
+            pd.DataFrame(db.execute(sql, params).fetchall())
+            db.close()
+    reconnecting = (time.time() - start) / runs
+    start = time.time()
+    for _ in xrange(runs):
+        for name in REPORT_QUERIES:
+            report(name)
+    pooled = (time.time() - start) / runs
+    direct.close()
+    print "{0} reports: {1:.4f} s reconnecting, {2:.4f} s pooled".format(len(REPORT_QUERIES), reconnecting, pooled)
+
+
+if __name__ == '__main__':
+    test()
+
+
+# In[ ]:
+
+# This block runs the report cells below as one batch.  Each report is a
+# query from REPORT_QUERIES and its parameters, so the user the per-user
+# reports look at is only set in REPORT_USER, not in each cell.  The reports
+# don't depend on each other, so with more than one cpu they run at the same
+# time on a thread pool, each on a pooled read-only connection (sqlite lets
+# go of the GIL while it runs a query).  Results are cached by query,
+# parameters and the modification time of the database, so the cells read
+# them from the cache until the database is written to again.  The cache is
+# where most of the time is saved: the reports only take a few hundredths of
+# a second between them, most of it in the two per-user reports.
+import multiprocessing
+import os
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import pandas as pd
+
+# The reports in OpenStreetMap-Report.md, as (report name, parameters), all
+# of them with their own parameters
+REPORT_RUNS = [(name, None) for name in REPORT_QUERIES]
+
+# Threads running reports at once, one per pooled connection and no more than
+# there are cpus to run the queries on
+REPORT_WORKERS = min(POOL_SIZE, multiprocessing.cpu_count())
+
+class ReportRunner(object):
+    """Runs REPORT_QUERIES on the pooled connections to a database and caches the results
+
+    A cached result is kept while the database file keeps the same
+    modification time, and handed out as a copy so a cell can change its
+    DataFrame without changing the cache.
+    """
+
+    def __init__(self, db_path=DB_PATH, workers=REPORT_WORKERS, queries=REPORT_QUERIES):
+        self.db_path = db_path
+        self.workers = workers
+        self.queries = queries
+        self.cache = {}
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def cache_key(self, name, params=None):
+        sql, params = report_query(name, params, self.queries)
+        return sql, tuple(params), os.path.getmtime(self.db_path)
+
+    def run(self, name, params=None):
+        """One report as a DataFrame, with its own parameters unless params are given"""
+        # The modification time is read before the query, so a write while
+        # it runs leaves the result under a key that is already out of date
+        key = self.cache_key(name, params)
+        with self.lock:
+            frame = self.cache.get(key)
+        if frame is None:
+            sql, params, mtime = key
+            frame = read_frame(sql, params, self.db_path)
+            with self.lock:
+                for stale in [k for k in self.cache if k[2] != mtime]:
+                    del self.cache[stale]
+                self.cache[key] = frame
+        return frame.copy()
+
+    def run_all(self, runs=REPORT_RUNS):
+        """The DataFrames of a list of (report name, parameters), run on the thread pool"""
+        # With one worker, handing the reports to a thread only adds to the time
+        if self.workers <= 1:
+            return [self.run(*run) for run in runs]
+        
+        # The pool is started once and kept, joining one takes a tenth of a
+        # second, longer than all the reports take to run
+        with self.lock:
+            if self.pool is None:
+                self.pool = ThreadPool(self.workers)
+        return self.pool.map(lambda run: self.run(*run), runs)
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+
+    def close(self):
+        """Stop the thread pool"""
+        with self.lock:
+            pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+REPORT_RUNNER = ReportRunner()
+
+def run_report(name, params=None):
+    return REPORT_RUNNER.run(name, params)
+
+def run_reports(runs=REPORT_RUNS):
+    return REPORT_RUNNER.run_all(runs)
+
+
+def test():
+    global REPORT_USER
+    runner = ReportRunner()
+    frames = runner.run_all()
+    
+    # The batch gives the same frames as running the reports one by one
+    for (name, params), frame in zip(REPORT_RUNS, frames):
+        assert frame.equals(report(name, params)), name
+    assert len(runner.cache) == len(REPORT_RUNS)
+    
+    # Changing a frame leaves the cached one as it was
+    frame = runner.run('top_users')
+    frame['total'] = 0
+    assert runner.run('top_users').equals(report('top_users'))
+    
+    # Other parameters are another cache entry
+    runner.run('user_node_keys', ('',))
+    assert len(runner.cache) == len(REPORT_RUNS) + 1
+    
+    # The per-user reports read REPORT_USER when they run
+    user = REPORT_USER
+    try:
+        REPORT_USER = ''
+        assert run_report('user_node_keys').empty and report('user_way_keys').empty
+    finally:
+        REPORT_USER = user
+    assert not runner.run('user_node_keys').empty
+    
+    # A newer database file drops the cached results
+    stat = os.stat(DB_PATH)
+    os.utime(DB_PATH, (stat.st_atime, stat.st_mtime + 1))
+    try:
+        runner.run('postcodes')
+        assert runner.cache.keys() == [runner.cache_key('postcodes')]
+    finally:
+        os.utime(DB_PATH, (stat.st_atime, stat.st_mtime))
+    
+    # All the reports one after another, in a batch and from the cache
+    runs = 10
+    start = time.time()
+    for _ in xrange(runs):
+        for name, params in REPORT_RUNS:
+            report(name, params)
+    sequential = (time.time() - start) / runs
+    start = time.time()
+    for _ in xrange(runs):
+        runner.clear()
+        runner.run_all()
+    batch = (time.time() - start) / runs
+    start = time.time()
+    for _ in xrange(runs):
+        runner.run_all()
+    cached = (time.time() - start) / runs
+    runner.close()
+    print "{0} reports: {1:.4f} s one by one, {2:.4f} s in a batch of {3} workers, {4:.4f} s cached".format(
+        len(REPORT_RUNS), sequential, batch, runner.workers, cached)
+
+
+if __name__ == '__main__':
+    test()
+
+
 # In[121]:
 
 # Distribution of Postal Codes
@@ -1474,57 +4822,34 @@ conn.close()
 #
 
 
-import sqlite3
 import pandas as pd
 
-# This will show the distribution of postal codes
-db = sqlite3.connect("west-springfield.db")
-c = db.cursor()
-query = '''
-select value, count(*) as total from nodes_tags 
-where key='postcode' group by value order by total desc;
-'''
-c.execute(query)
-rows = c.fetchall()
+# Run all the reports at once, the cells below read them from the cache
+run_reports()
 
-# rows.sort()
+# This will show the distribution of postal codes
+df = run_report('postcodes')
 
 # And let's loop over it too:
 #print
 print "Ids and User names:"
-for row in rows:
+for row in df.itertuples(index=False):
     print row[0], "  ", row[1]
     
-df = pd.DataFrame(rows)
 print df    
 
-db.close()
-
 
 # In[122]:
 
 # Kinds of Amenities
 #
 
-import sqlite3
 import pandas as pd
 
 # This will show the distribution of amenities
-db = sqlite3.connect("west-springfield.db")
-c = db.cursor()
-query = '''
-select value, count(*) as total from nodes_tags
-where key='amenity'
-group by value order by total desc;
-'''
-c.execute(query)
-rows = c.fetchall()
-    
-df = pd.DataFrame(rows)
+df = run_report('amenities')
 print df    
 
-db.close()
-
 
 # In[123]:
 
@@ -1532,23 +4857,9 @@ db.close()
 #
 
 # This will show the distribution of amenities
-db = sqlite3.connect("west-springfield.db")
-c = db.cursor()
-query = '''
-select user, count(*) as total
-from (select user from nodes union all select user from ways)
-group by user
-order by total desc
-limit 10;
-'''
-c.execute(query)
-rows = c.fetchall()
-    
-df = pd.DataFrame(rows)
+df = run_report('top_users')
 print df    
 
-db.close()
-
 
 # In[106]:
 
@@ -1556,23 +4867,9 @@ db.close()
 #
 
 # This will show the distribution of amenities
-db = sqlite3.connect("west-springfield.db")
-c = db.cursor()
-query = '''
-select key, count(*) as total
-from nodes, nodes_tags
-where nodes.id = nodes_tags.id and user='Tomash Pilshchik'
-group by key
-order by total desc;
-'''
-c.execute(query)
-rows = c.fetchall()
-    
-df = pd.DataFrame(rows)
+df = run_report('user_node_keys')
 print df    
 
-db.close()
-
 
 # In[107]:
 
@@ -1580,23 +4877,9 @@ db.close()
 #
 
 # This will show the distribution of amenities
-db = sqlite3.connect("west-springfield.db")
-c = db.cursor()
-query = '''
-select key, count(*) as total
-from ways, ways_tags
-where ways.id = ways_tags.id and user='Tomash Pilshchik'
-group by key
-order by total desc;
-'''
-c.execute(query)
-rows = c.fetchall()
-    
-df = pd.DataFrame(rows)
+df = run_report('user_way_keys')
 print df    
 
-db.close()
-
 
 # In[96]:
 
@@ -1604,24 +4887,12 @@ db.close()
 # This will show the distribution of nodes tags
 #
 
-import sqlite3
 import pandas as pd
 
 # This will show the distribution of postal codes
-db = sqlite3.connect("west-springfield.db")
-c = db.cursor()
-query = '''
-select key, count(*) as total from nodes_tags
-group by key order by total desc;
-'''
-c.execute(query)
-rows = c.fetchall()
-    
-df = pd.DataFrame(rows)
+df = run_report('node_tag_keys')
 print df    
 
-db.close()
-
 
 # In[110]:
 
@@ -1629,24 +4900,12 @@ db.close()
 # This will show the distribution of nodes tags
 #
 
-import sqlite3
 import pandas as pd
 
 # This will show the distribution of postal codes
-db = sqlite3.connect("west-springfield.db")
-c = db.cursor()
-query = '''
-select key, count(*) as total from ways_tags
-group by key order by total desc;
-'''
-c.execute(query)
-rows = c.fetchall()
-    
-df = pd.DataFrame(rows)
+df = run_report('way_tag_keys')
 print df    
 
-db.close()
-
 
 # In[ ]:
 
@@ -1659,25 +4918,14 @@ db.close()
 # This will show the distribution of nodes tags
 #
 
-import sqlite3
 import pandas as pd
 
 # This will show the distribution of postal codes
-db = sqlite3.connect("west-springfield.db")
-c = db.cursor()
-query = '''
-select value, count(*) as total from ways_tags
-where key='name'
-group by value order by total desc;
-'''
-c.execute(query)
-rows = c.fetchall()
+df = run_report('highway_names')
     
 print "Highway Names and Totals:"
-for row in rows:
-    print row[0]#, "  ", row[1]
-
-db.close()
+for value in df['value']:
+    print value
 
 
 # In[ ]: